@@ -3,7 +3,7 @@
 import datetime
 import numbers
 
-import httpx
+from fedcloud_monitoring_tools.http_client import shared_client
 
 ACCOUNTING_DAYS = 90
 ACCOUNTING_URL = "https://accounting.egi.eu/"
@@ -13,79 +13,183 @@ SITE_VO_ACCOUNTING = (
     "/all/onlyinfrajobs/JSON/"
 )
 
+# rows of the accounting matrix that are not sites
+NON_SITE_ROWS = ["Total", "Percent", "var", "xlegend", "ylegend"]
+# columns of the site rows that are not VOs
+NON_VO_COLUMNS = ["id", "Total", "Percent"]
+
+
+def _is_cpuh(value):
+    if isinstance(value, numbers.Number):
+        return True
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
 
 class Accounting:
-    def __init__(self, days=ACCOUNTING_DAYS):
-        self._data = {}
+    def __init__(self, days=ACCOUNTING_DAYS, store=None, http=None, today=None):
         self.days = days
+        # last day of the accounting window, None for the current date
+        self.today = today
+        self.http = http or shared_client()
+        # AccountingStore, if given the data is fetched and kept month by month
+        self.store = store
+        # (year, month) -> site -> {VO: CPUh}, only with a store
+        self._months = {}
+        # site -> {VO: CPUh}, only with the VOs having accounting at the site
+        self._site_vos = None
+        # VO -> {site: CPUh}, only with the sites having CPUh > 0 for the VO
+        self._vo_sites = None
+        self._sites = []
+        self._vos = None
 
-    def _get_accounting_data(self):
-        """Gets accounting data for sites / vos over the last 90 days"""
-        today = datetime.date.today()
+    def _months_in_window(self):
+        """Returns the (year, month) covered by the last self.days, oldest first"""
+        today = self.today or datetime.date.today()
         start = today - datetime.timedelta(days=self.days)
+        months = []
+        year, month = start.year, start.month
+        while (year, month) <= (today.year, today.month):
+            months.append((year, month))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return months
+
+    def _fetch(self, start, end):
         url = ACCOUNTING_URL + SITE_VO_ACCOUNTING.format(
-            start_year=start.year,
-            start_month=start.month,
-            end_year=today.year,
-            end_month=today.month,
+            start_year=start[0],
+            start_month=start[1],
+            end_year=end[0],
+            end_month=end[1],
         )
         # accounting generates a redirect here
-        r = httpx.get(url, follow_redirects=True)
-        self._data = r.json()
-        return self._data
+        r = self.http.get(url, follow_redirects=True)
+        return r.json()
 
-    def site_vos(self, site):
-        if not self._data:
+    def _get_accounting_data(self):
+        """Gets accounting data for sites / vos over the last self.days"""
+        months = self._months_in_window()
+        if self.store is None:
+            self._index(self._fetch(months[0], months[-1]))
+            return
+        sites = {}
+        legends = {"xlegend": {}, "ylegend": {}}
+        for year, month in months:
+            data = self.store.get(year, month)
+            if data is None:
+                data = self._fetch((year, month), (year, month))
+                self.store.set(year, month, data)
+            usage = {}
+            for row in data:
+                if row["id"] in legends:
+                    for key, value in row.items():
+                        if key != "id":
+                            legends[row["id"]][value] = None
+                    continue
+                if row["id"] in NON_SITE_ROWS:
+                    continue
+                for vo, value in row.items():
+                    if vo in NON_VO_COLUMNS or not _is_cpuh(value):
+                        continue
+                    usage.setdefault(row["id"], {})[vo] = float(value)
+                    site_total = sites.setdefault(row["id"], {})
+                    site_total[vo] = site_total.get(vo, 0.0) + float(value)
+            self._months[(year, month)] = usage
+        # same format as the data of the whole window from the portal
+        combined = [{"id": site, **vos} for site, vos in sites.items()]
+        for legend, values in legends.items():
+            combined.append(
+                {"id": legend, **{str(i): value for i, value in enumerate(values)}}
+            )
+        self._index(combined)
+
+    def _index(self, data):
+        """Builds the site and VO indexes from the rows of the JSON matrix"""
+        self._site_vos = {}
+        self._vo_sites = {}
+        self._sites = []
+        self._vos = None
+        rows = []
+        for row in data:
+            if row["id"] == "xlegend":
+                self._sites = [site for key, site in row.items() if key != "id"]
+            elif row["id"] == "ylegend":
+                self._vos = [vo for vo in row.values() if vo not in ["ylegend", "id"]]
+            elif row["id"] not in NON_SITE_ROWS:
+                rows.append(row)
+        for row in rows:
+            self._site_vos.setdefault(row["id"], {}).update(
+                {
+                    vo: float(value)
+                    for vo, value in row.items()
+                    if vo not in NON_VO_COLUMNS
+                    and _is_cpuh(value)
+                    and float(value) != 0
+                }
+            )
+        for vo in self._vos or []:
+            sites = {}
+            for row in rows:
+                if _is_cpuh(row.get(vo)) and float(row[vo]) > 0.0:
+                    sites[row["id"]] = float(row[vo])
+            # it may happen that the VO doesn't have accounting after all
+            if sites:
+                self._vo_sites[vo] = sites
+
+    def _load(self):
+        if self._site_vos is None:
             self._get_accounting_data()
-        for col in self._data:
-            if col["id"] == site:
-                return set(
-                    [
-                        vo[0]
-                        for vo in col.items()
-                        if isinstance(vo[1], numbers.Number)
-                        and vo[1] != 0
-                        and vo[0] not in ["Total", "Percent"]
-                    ]
-                )
-        return set([])
+
+    def site_vos(self, site):
+        self._load()
+        return set(self._site_vos.get(site, {}))
+
+    def site_accounting(self, site):
+        """Returns a dict with the CPUh of each VO with accounting at the site"""
+        self._load()
+        return self._site_vos.get(site, {})
 
     def all_sites(self):
-        if not self._data:
-            self._get_accounting_data()
-        for col in self._data:
-            if col["id"] == "xlegend":
-                return [site[1] for site in col.items() if site[0] != "id"]
-        return []
+        self._load()
+        return self._sites
 
     def all_vos(self):
-        if not self._data:
-            self._get_accounting_data()
-        for col in self._data:
-            if col["id"] == "ylegend":
-                return [vo for vo in col.values() if vo != "ylegend" and vo != "id"]
+        self._load()
+        return self._vos
 
-    def accounting_all_vos(self):
-        active_VOs = {}
-        for vo in self.all_vos():
-            active_VOs[vo] = {}
-            for i in self._data:
-                if (
-                    i["id"] != "Total"
-                    and i["id"] != "Percent"
-                    and i["id"] != "var"
-                    and i["id"] != "xlegend"
-                    and i["id"] != "ylegend"
-                    and vo in i
-                    and i[vo] is not None
-                    and float(i[vo]) > 0.0
-                ):
-                    # loop over all sites having > 0 CPUh for this VO
-                    site = i["id"]
-                    cpuh = float(i[vo])
-                    active_VOs[vo][site] = cpuh
-            # it may happen that the VO doesn't have accounting after all
-            if len(active_VOs[vo]) == 0:
-                active_VOs.pop(vo)
+    def monthly_usage(self, site, vo):
+        """Returns a list of ((year, month), CPUh) of the VO at the site
+
+        Months are sorted, oldest first. It's only available with a store.
+        """
+        self._load()
+        return [
+            (month, usage.get(site, {}).get(vo, 0.0))
+            for month, usage in sorted(self._months.items())
+        ]
+
+    def stopped_vos(self, site):
+        """Returns the VOs with accounting at the site but none last month
 
-        return active_VOs
+        Only complete months are considered, and at least two are needed.
+        It's only available with a store.
+        """
+        self._load()
+        today = self.today or datetime.date.today()
+        months = [m for m in sorted(self._months) if m != (today.year, today.month)]
+        if len(months) < 2:
+            return set()
+        previous_vos = set()
+        for month in months[:-1]:
+            previous_vos.update(
+                vo for vo, cpuh in self._months[month].get(site, {}).items() if cpuh > 0
+            )
+        last_vos = self._months[months[-1]].get(site, {})
+        return set(vo for vo in previous_vos if last_vos.get(vo, 0.0) <= 0)
+
+    def accounting_all_vos(self):
+        """Returns a dict with VO as key and a dict of site: CPUh as value"""
+        self._load()
+        return self._vo_sites
@@ -0,0 +1,91 @@
+"""Site x VO matrix of the accounting data for federation-wide queries
+
+It needs numpy, which is an optional dependency of the package.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class AccountingMatrix:
+    """Dense matrix of CPU hours with a row per site and a column per VO"""
+
+    def __init__(self, sites, vos, cpuh=None):
+        if np is None:
+            raise ImportError("numpy is needed for the accounting matrix")
+        self.sites = np.array(sites, dtype=object)
+        self.vos = np.array(vos, dtype=object)
+        if cpuh is None:
+            cpuh = np.zeros((len(sites), len(vos)))
+        self.cpuh = np.asarray(cpuh, dtype=float).reshape(len(sites), len(vos))
+        self._site_index = {site: i for i, site in enumerate(sites)}
+        self._vo_index = {vo: i for i, vo in enumerate(vos)}
+
+    @classmethod
+    def from_accounting(cls, acct):
+        """Builds the matrix with the CPUh > 0 of an Accounting"""
+        vo_sites = acct.accounting_all_vos()
+        sites = list(acct.all_sites())
+        known_sites = set(sites)
+        for vo_site in sorted(
+            set(site for by_site in vo_sites.values() for site in by_site)
+        ):
+            if vo_site not in known_sites:
+                sites.append(vo_site)
+        vos = list(vo_sites)
+        matrix = cls(sites, vos)
+        for j, vo in enumerate(vos):
+            for site, cpuh in vo_sites[vo].items():
+                matrix.cpuh[matrix._site_index[site], j] = cpuh
+        return matrix
+
+    def _columns(self, vos):
+        return [self._vo_index[vo] for vo in vos if vo in self._vo_index]
+
+    def top_vos(self, site, n=5):
+        """Returns up to n (VO, CPUh) with the highest usage at the site"""
+        if site not in self._site_index:
+            return []
+        row = self.cpuh[self._site_index[site]]
+        top = np.argsort(row, kind="stable")[::-1][:n]
+        return [(self.vos[j], float(row[j])) for j in top if row[j] > 0]
+
+    def zero_usage_sites(self, vos, sites=None):
+        """Returns the sorted sites without usage for any of the vos
+
+        If sites is given, only those are checked and the ones not in the
+        matrix have no usage.
+        """
+        usage = self.cpuh[:, self._columns(vos)].sum(axis=1)
+        idle = set(self.sites[usage == 0])
+        if sites is None:
+            return sorted(idle)
+        return sorted(
+            site for site in sites if site in idle or site not in self._site_index
+        )
+
+    def vo_totals(self):
+        """Returns a dict with the total CPUh of each VO"""
+        return dict(zip(self.vos, self.cpuh.sum(axis=0).tolist()))
+
+    def site_totals(self):
+        """Returns a dict with the total CPUh of each site"""
+        return dict(zip(self.sites, self.cpuh.sum(axis=1).tolist()))
+
+    def vo_shares(self):
+        """Returns a dict with the percentage of the total CPUh of each VO"""
+        totals = self.cpuh.sum(axis=0)
+        total = totals.sum()
+        shares = totals / total * 100 if total else np.zeros_like(totals)
+        return dict(zip(self.vos, shares.tolist()))
+
+    def site_shares(self, vo):
+        """Returns a dict with the percentage of the CPUh of the VO at each site"""
+        if vo not in self._vo_index:
+            return {}
+        column = self.cpuh[:, self._vo_index[vo]]
+        total = column.sum()
+        shares = column / total * 100 if total else np.zeros_like(column)
+        return dict(zip(self.sites, shares.tolist()))
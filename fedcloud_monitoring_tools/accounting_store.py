@@ -0,0 +1,77 @@
+"""Local store of the monthly accounting data"""
+
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+
+ACCOUNTING_STORE_FILE = "accounting.sqlite"
+# months are final when fetched this number of days after they ended
+ACCOUNTING_SETTLE_DAYS = 15
+# seconds the data of a month that is still changing is reused
+ACCOUNTING_REFRESH = 6 * 3600
+
+
+class AccountingStore:
+    """SQLite store of the accounting portal JSON of each month
+
+    A month is fetched again on later runs until it is final, i.e. it was
+    fetched settle_days after its end, as late records may still arrive.
+    It can be shared between threads.
+    """
+
+    def __init__(
+        self,
+        store_dir,
+        settle_days=ACCOUNTING_SETTLE_DAYS,
+        refresh=ACCOUNTING_REFRESH,
+    ):
+        os.makedirs(store_dir, exist_ok=True)
+        self.path = os.path.join(store_dir, ACCOUNTING_STORE_FILE)
+        self.settle_days = settle_days
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS months ("
+                "year INTEGER, month INTEGER, fetched REAL, data TEXT, "
+                "PRIMARY KEY (year, month))"
+            )
+
+    def is_final(self, year, month, fetched):
+        if month == 12:
+            month_end = datetime.date(year + 1, 1, 1)
+        else:
+            month_end = datetime.date(year, month + 1, 1)
+        fetched_date = datetime.date.fromtimestamp(fetched)
+        return fetched_date >= month_end + datetime.timedelta(days=self.settle_days)
+
+    def get(self, year, month):
+        """Returns the data of the month or None if missing or outdated"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT fetched, data FROM months WHERE year = ? AND month = ?",
+                (year, month),
+            ).fetchone()
+        if row is None:
+            return None
+        fetched, data = row
+        if not self.is_final(year, month, fetched) and (
+            time.time() - fetched >= self.refresh
+        ):
+            return None
+        return json.loads(data)
+
+    def set(self, year, month, data):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO months VALUES (?, ?, ?, ?)",
+                (year, month, time.time(), json.dumps(data)),
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
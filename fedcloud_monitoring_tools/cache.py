@@ -0,0 +1,97 @@
+"""Persistent cache for data that rarely changes between runs"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "fedcloud-monitoring-tools",
+)
+CACHE_FILE = "cache.sqlite"
+# seconds entries of each kind are considered valid
+CACHE_TTLS = {
+    "flavors": 24 * 3600,
+    "image": 7 * 24 * 3600,
+    "volume": 24 * 3600,
+    "users": 3600,
+    "sla_groups": 24 * 3600,
+    # keyed by the modification time of the mapping file
+    "vo_map": 30 * 24 * 3600,
+}
+DEFAULT_TTL = 3600
+CACHE_MAX_ENTRIES = 50000
+
+
+class PersistentCache:
+    """SQLite store of JSON values keyed by site, VO, kind and key
+
+    Entries expire after the TTL of their kind and the oldest ones are
+    evicted when there are more than max_entries. Hits and misses are
+    counted per kind. It can be shared between threads.
+    """
+
+    def __init__(
+        self, cache_dir=CACHE_DIR, ttls=CACHE_TTLS, max_entries=CACHE_MAX_ENTRIES
+    ):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, CACHE_FILE)
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.hits = Counter()
+        self.misses = Counter()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "site TEXT, vo TEXT, kind TEXT, key TEXT, stored REAL, value TEXT, "
+                "PRIMARY KEY (site, vo, kind, key))"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS cache_age ON cache (stored)")
+
+    def get(self, site, vo, kind, key):
+        """Returns the cached value or None if missing or expired"""
+        min_stored = time.time() - self.ttls.get(kind, DEFAULT_TTL)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM cache "
+                "WHERE site = ? AND vo = ? AND kind = ? AND key = ? AND stored >= ?",
+                (site, vo or "", kind, key, min_stored),
+            ).fetchone()
+            if row is None:
+                self.misses[kind] += 1
+                return None
+            self.hits[kind] += 1
+        return json.loads(row[0])
+
+    def set(self, site, vo, kind, key, value):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)",
+                (site, vo or "", kind, key, time.time(), json.dumps(value)),
+            )
+            self._evict()
+
+    def _evict(self):
+        (count,) = self._db.execute("SELECT COUNT(*) FROM cache").fetchone()
+        if count > self.max_entries:
+            self._db.execute(
+                "DELETE FROM cache WHERE rowid IN "
+                "(SELECT rowid FROM cache ORDER BY stored LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def stats(self):
+        """Returns a dict with kind as key and (hits, misses) as value"""
+        return {
+            kind: (self.hits[kind], self.misses[kind])
+            for kind in sorted(set(self.hits) | set(self.misses))
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -1,30 +1,71 @@
 """FedCloud Information System queries"""
 
-import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from fedcloud_monitoring_tools.http_client import shared_client
+
+IS_URL = "https://is.cloud.egi.eu"
+# seconds the answers of the IS are reused
+IS_TTL = 3600
+# maximum number of concurrent queries when prefetching all the sites
+IS_WORKERS = 10
 
 
 class FedCloudIS:
-    def __init__(self):
+    """Queries the IS, keeping the answers for ttl seconds
+
+    The sites of a VO and the VOs of a site are queried (and kept) one at
+    a time. prefetch gets the VOs of all the sites at once, after that both
+    directions are answered from the prefetched index until it expires.
+    """
+
+    def __init__(self, http=None, ttl=IS_TTL, workers=IS_WORKERS):
+        self.http = http or shared_client()
+        self.ttl = ttl
+        self.workers = max(1, workers)
+        # VO -> (time of the query, sites of the VO)
         self.sites = {}
+        # site -> (time of the query, VOs of the site)
+        self.vos = {}
+        # site -> VOs and VO -> sites of the prefetched index
+        self._site_vos = {}
+        self._vo_sites = {}
+        self._prefetched = None
+        self._lock = threading.Lock()
 
-    def get_sites_for_vo(self, vo):
-        query = f"https://is.cloud.egi.eu/sites/?vo_name={vo}"
-        r = requests.get(query)
+    def _is_fresh(self, fetched):
+        return fetched is not None and time.monotonic() - fetched < self.ttl
+
+    def _query_sites_for_vo(self, vo):
+        query = f"{IS_URL}/sites/?vo_name={vo}"
+        r = self.http.get(query)
         r.raise_for_status()
         data = r.json()
         return [site["name"] for site in data]
 
+    def get_sites_for_vo(self, vo):
+        with self._lock:
+            if self._is_fresh(self._prefetched):
+                return list(self._vo_sites.get(vo, []))
+            if vo in self.sites and self._is_fresh(self.sites[vo][0]):
+                return list(self.sites[vo][1])
+        sites = self._query_sites_for_vo(vo)
+        with self._lock:
+            self.sites[vo] = (time.monotonic(), sites)
+        return list(sites)
+
     def vo_check(self, site, vo):
-        if not self.sites:
-            self.sites = self.get_sites_for_vo(vo)
-        return site in self.sites
+        return site in self.get_sites_for_vo(vo)
 
-    def get_vos_for_site(self, site):
+    def _query_vos_for_site(self, site):
         try:
-            query = f"https://is.cloud.egi.eu/site/{site}/projects"
-            r = requests.get(query)
+            query = f"{IS_URL}/site/{site}/projects"
+            r = self.http.get(query)
             r.raise_for_status()
-        except requests.exceptions.HTTPError:
+        except httpx.HTTPStatusError:
             return []
         data = r.json()
         if data:
@@ -32,8 +73,41 @@ class FedCloudIS:
         else:
             return []
 
+    def prefetch(self):
+        """Gets the VOs of all the sites, unless already done within ttl"""
+        with self._lock:
+            if self._is_fresh(self._prefetched):
+                return
+            query = f"{IS_URL}/sites/"
+            r = self.http.get(query)
+            r.raise_for_status()
+            sites = [site["name"] for site in r.json()]
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                site_vos = dict(
+                    zip(sites, executor.map(self._query_vos_for_site, sites))
+                )
+            vo_sites = {}
+            for site, vos in site_vos.items():
+                for vo in vos:
+                    vo_sites.setdefault(vo, []).append(site)
+            self._site_vos = site_vos
+            self._vo_sites = vo_sites
+            self._prefetched = time.monotonic()
+
+    def get_vos_for_site(self, site):
+        with self._lock:
+            if self._is_fresh(self._prefetched) and site in self._site_vos:
+                return list(self._site_vos[site])
+            if site in self.vos and self._is_fresh(self.vos[site][0]):
+                return list(self.vos[site][1])
+        # not prefetched or not in the list of sites of the IS, ask for it
+        vos = self._query_vos_for_site(site)
+        with self._lock:
+            self.vos[site] = (time.monotonic(), vos)
+        return list(vos)
+
     def all_vos(self):
-        query = "https://is.cloud.egi.eu/vos/"
-        r = requests.get(query)
+        query = f"{IS_URL}/vos/"
+        r = self.http.get(query)
         r.raise_for_status()
         return r.json()
@@ -1,121 +1,239 @@
 """Classes to interact with the GOCDB"""
 
 import re
-from xml.parsers.expat import ExpatError
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from xml.etree.ElementTree import ParseError
 
 import httpx
-import xmltodict
+from fedcloud_monitoring_tools.goc_xml import (
+    ServiceEndpoint,
+    parse_service_groups,
+    parse_services,
+)
+from fedcloud_monitoring_tools.http_client import shared_client
 
 GOC_PUBLIC_URL = "https://goc.egi.eu/gocdbpi/public/"
 GOC_PRIVATE_URL = "https://goc.egi.eu/gocdbpi/private/"
 SERVICE_TYPES = ["org.openstack.nova"]
 SLA_GROUP_RE = r"EGI_(.*)_SLA"
+# maximum number of concurrent queries to the GOCDB public API
+GOC_WORKERS = 10
+# site and VO of the SLA groups in the persistent cache
+CACHE_SITE = "GOCDB"
+CACHE_VO = None
+
+
+@dataclass(slots=True)
+class Sla:
+    """SLA service group, the VOs of each SLA come from the VO map"""
+
+    name: str
+    endpoints: list[ServiceEndpoint] = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, value):
+        return cls(value["name"], [ServiceEndpoint(**e) for e in value["endpoints"]])
+
+    @property
+    def sites(self):
+        """Sites of the endpoints, once per endpoint"""
+        return [endpoint.site for endpoint in self.endpoints if endpoint.site]
 
 
 class GOCDB:
-    def __init__(self):
+    def __init__(self, workers=GOC_WORKERS, cache=None, http=None):
         self._cache = {}
+        # PersistentCache for the SLAs, None to get them from GOCDB every run
+        self.cache = cache
+        # list of Sla by scope, see get_slas
+        self._slas = {}
         self.queries = 0
         self.sla_vos = set()
+        self.workers = max(1, workers)
+        self.http = http or shared_client()
+        self._lock = threading.Lock()
+        # sites of the SERVICE_TYPES endpoints by primary key and (hostname, type)
+        self._sites_by_key = None
+        self._sites_by_host = None
+        self._index_lock = threading.Lock()
+
+    def _query(self, url, params, parse, cert_file=None):
+        """Returns the list of records parsed while the response is received"""
+        with self.http.stream(url, params, cert=cert_file) as r:
+            with self._lock:
+                self.queries += 1
+            return list(parse(r.iter_bytes()))
 
     def get_sla_groups(self, cert_file, scope="EGI,SLA"):
-        client = httpx.Client(cert=cert_file)
+        """Returns the list of ServiceGroup in scope"""
         params = {"method": "get_service_group", "scope": scope}
-        response = client.get(GOC_PRIVATE_URL, params=params)
-        self.queries += 1
         try:
-            groups = xmltodict.parse(response.text)["results"]["SERVICE_GROUP"]
-        except ExpatError:
-            print(f"\nXML to be parsed:\n{response.text}\n")
+            return self._query(GOC_PRIVATE_URL, params, parse_service_groups, cert_file)
+        except ParseError as e:
+            print(f"\nXML parsing error: {e}\n")
             exit("Cannot parse XML received from GOCDB.")
-        return groups
 
-    def flatten_vo_map(self, vo_map):
-        all_vos = []
-        for vo in vo_map.values():
-            if vo:
-                all_vos.extend(vo)
-        return set(all_vos)
+    def get_slas(self, cert_file, scope="EGI,SLA"):
+        """Returns the list of Sla of the SLA service groups in scope
+
+        They are built once, with the sites of their endpoints resolved,
+        and kept for the following calls (and runs, if there is a cache).
+        """
+        if scope in self._slas:
+            return self._slas[scope]
+        cached = None
+        if self.cache:
+            cached = self.cache.get(CACHE_SITE, CACHE_VO, "sla_groups", scope)
+        if cached is not None:
+            slas = [Sla.from_dict(sla) for sla in cached]
+        else:
+            groups = self.get_sla_groups(cert_file, scope)
+            self.resolve_endpoints(groups)
+            slas = []
+            for group in groups:
+                m = re.search(SLA_GROUP_RE, group.name)
+                if not m:
+                    continue
+                for endpoint in group.endpoints:
+                    endpoint.site = self.get_endpoint_site(endpoint)
+                slas.append(Sla(m.group(1), group.endpoints))
+            if self.cache:
+                self.cache.set(
+                    CACHE_SITE,
+                    CACHE_VO,
+                    "sla_groups",
+                    scope,
+                    [asdict(sla) for sla in slas],
+                )
+        self._slas[scope] = slas
+        return slas
 
     def get_sites_vo(self, cert_file, vo_map):
-        groups = self.get_sla_groups(cert_file)
-        self.sla_vos = self.flatten_vo_map(vo_map)
+        slas = self.get_slas(cert_file)
+        self.sla_vos = set(vo_map.vos)
 
         sites_per_vo = {}
-        for group in groups:
-            m = re.search(SLA_GROUP_RE, group["NAME"])
-            if not m:
-                continue
-            sla_name = m.group(1)
-            vos = vo_map.get(sla_name)
-            if vos is not None and len(vos) != 1:
+        for sla in slas:
+            vos = vo_map.vos_of_sla(sla.name)
+            if vo_map.is_multi_vo(sla.name):
                 # SLA service groups in GOCDB with multiple VOs are special.
                 # All nova endpoints in the service group do not support all VOs.
                 # Therefore, a special value is added to be treated accordingly.
                 for vo in vos:
                     sites_per_vo[vo] = ["sla-group-with-multiple-vos"]
                 continue
-            elif vos is None:
+            elif not vos:
                 # This SLA service group does not have a VO associated, skipping
                 continue
             # from this point on, there will be only one VO in the SLA service group in GOCDB
             # in these cases we can extract the list of providers supporting the VO properly
-            sla_vo = vos[0]
-            endpoints = group.get("SERVICE_ENDPOINT", [])
-            if not isinstance(endpoints, list):
-                endpoints = [endpoints]
-            sites_per_vo[sla_vo] = []
-            for endpoint in endpoints:
-                svc = self.get_endpoint_site(endpoint)
-                if svc:
-                    site = svc["SITENAME"]
-                    sites_per_vo[sla_vo].append(site)
+            sites_per_vo[vos[0]] = sla.sites
         return sites_per_vo
 
     def get_sites_slas(self, cert_file, vo_map):
-        groups = self.get_sla_groups(cert_file)
-        self.sla_vos = self.flatten_vo_map(vo_map)
+        slas = self.get_slas(cert_file)
+        self.sla_vos = set(vo_map.vos)
 
         sites = {}
-        for group in groups:
-            m = re.search(SLA_GROUP_RE, group["NAME"])
-            if not m:
-                continue
-            sla_name = m.group(1)
-            vos = vo_map.get(sla_name)
-            endpoints = group.get("SERVICE_ENDPOINT", [])
-            if not isinstance(endpoints, list):
-                endpoints = [endpoints]
-            for endpoint in endpoints:
-                svc = self.get_endpoint_site(endpoint)
-                if svc:
-                    site = svc["SITENAME"]
-                    site_info = sites.get("site", dict())
-                    site_info[sla_name] = {"vos": set(vos or [])}
-                    if site in sites:
-                        sites[site].update(site_info)
-                    else:
-                        sites[site] = site_info
+        for sla in slas:
+            vos = vo_map.vos_of_sla(sla.name)
+            for site in sla.sites:
+                sites.setdefault(site, {})[sla.name] = {"vos": set(vos)}
         return sites
 
+    def resolve_endpoints(self, groups):
+        """Gets the sites of all the endpoints of the groups into _cache
+
+        Endpoints are taken from the service index, the ones not found
+        there are queried once each, with up to self.workers concurrent
+        queries.
+        """
+        endpoints = {}
+        for group in groups:
+            for endpoint in group.endpoints:
+                if endpoint.key in self._cache or endpoint.key in endpoints:
+                    continue
+                if endpoint.service_type in SERVICE_TYPES:
+                    endpoints[endpoint.key] = endpoint
+        for key, endpoint in list(endpoints.items()):
+            site = self._lookup_site(endpoint)
+            if site:
+                self._cache[key] = site
+                del endpoints[key]
+        if not endpoints:
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            sites = executor.map(self._get_site, endpoints.values())
+            # endpoints not found are also cached, they are not queried again
+            for key, site in zip(endpoints, sites):
+                self._cache[key] = site
+
+    def _get_all_services(self, service_type):
+        """Returns all the endpoints of the type, following the result pages"""
+        url = GOC_PUBLIC_URL
+        params = {"method": "get_service", "service_type": service_type}
+        services = []
+        while url:
+            links = {}
+            services.extend(
+                self._query(url, params, lambda c: parse_services(c, links))
+            )
+            next_url = links.get("next")
+            url = next_url if next_url != url else None
+            # the next link already includes the query
+            params = None
+        return services
+
+    def get_service_index(self):
+        """Downloads all the endpoints of SERVICE_TYPES and indexes their sites
+
+        It's done once, with a single query per type (and result page).
+        If the download fails, the index is left empty and endpoints are
+        queried one by one.
+        """
+        with self._index_lock:
+            if self._sites_by_key is None:
+                by_key = {}
+                by_host = {}
+                try:
+                    for service_type in SERVICE_TYPES:
+                        for service in self._get_all_services(service_type):
+                            by_key.setdefault(service.key, service.site)
+                            by_host.setdefault(
+                                (service.hostname, service_type), service.site
+                            )
+                except (httpx.HTTPError, ParseError):
+                    by_key = {}
+                    by_host = {}
+                self._sites_by_key = by_key
+                self._sites_by_host = by_host
+            return self._sites_by_key, self._sites_by_host
+
+    def _lookup_site(self, endpoint):
+        by_key, by_host = self.get_service_index()
+        site = by_key.get(endpoint.key)
+        if site is None:
+            site = by_host.get((endpoint.hostname, endpoint.service_type))
+        return site
+
+    def _get_site(self, endpoint):
+        params = {"method": "get_service"}
+        if endpoint.hostname:
+            params["hostname"] = endpoint.hostname
+        if endpoint.service_type:
+            params["service_type"] = endpoint.service_type
+        services = self._query(GOC_PUBLIC_URL, params, parse_services)
+        return services[0].site if services else None
+
     def get_endpoint_site(self, endpoint):
-        key = endpoint["@PRIMARY_KEY"]
-        service = {}
-        if key in self._cache:
-            return self._cache[key]
-        if endpoint.get("SERVICE_TYPE", "") not in SERVICE_TYPES:
+        """Returns the site of the ServiceEndpoint or None if not found"""
+        if endpoint.key in self._cache:
+            return self._cache[endpoint.key]
+        if endpoint.service_type not in SERVICE_TYPES:
             return None
-        params = {"method": "get_service"}
-        if "HOSTNAME" in endpoint:
-            params["hostname"] = endpoint["HOSTNAME"]
-        if "SERVICE_TYPE" in endpoint:
-            params["service_type"] = endpoint["SERVICE_TYPE"]
-        r = httpx.get(GOC_PUBLIC_URL, params=params)
-        self.queries += 1
-        if r.text:
-            results = xmltodict.parse(r.text).get("results", {})
-            if results:
-                service = results.get("SERVICE_ENDPOINT", {})
-        if service:
-            self._cache[key] = service
-        return service
+        site = self._lookup_site(endpoint) or self._get_site(endpoint)
+        if site:
+            self._cache[endpoint.key] = site
+        return site
@@ -0,0 +1,114 @@
+"""Incremental parsing of the XML documents returned by GOCDB
+
+Only the fields used by the monitors are kept, as compact records, and the
+elements of the document are discarded as soon as each record is built,
+so responses can be parsed while they are downloaded.
+"""
+
+from dataclasses import dataclass, field
+from xml.etree.ElementTree import XMLPullParser
+
+
+@dataclass(slots=True)
+class ServiceEndpoint:
+    key: str
+    hostname: str = ""
+    service_type: str = ""
+    # None if the endpoint is not found or is not one of the SERVICE_TYPES
+    site: str | None = None
+
+
+@dataclass(slots=True)
+class ServiceGroup:
+    name: str = ""
+    endpoints: list[ServiceEndpoint] = field(default_factory=list)
+
+
+# child elements of SERVICE_ENDPOINT kept in ServiceEndpoint
+ENDPOINT_FIELDS = {
+    "HOSTNAME": "hostname",
+    "SERVICE_TYPE": "service_type",
+    "SITENAME": "site",
+}
+
+
+def _records(chunks):
+    """Yields (path, element) at the end of the elements inside the records
+
+    Records are the children of the root element, path is the tuple of
+    tags from the record down to the element. The record elements are
+    dropped from the tree once yielded. No records are yielded for an
+    empty document.
+    """
+    parser = XMLPullParser(events=("start", "end"))
+    path = []
+    root = None
+    empty = True
+
+    def read_events():
+        nonlocal root
+        for event, elem in parser.read_events():
+            if event == "start":
+                if root is None:
+                    root = elem
+                else:
+                    path.append(elem.tag)
+                continue
+            if not path:
+                continue
+            yield tuple(path), elem
+            path.pop()
+            if not path:
+                root.clear()
+
+    for chunk in chunks:
+        if chunk:
+            empty = False
+            parser.feed(chunk)
+            yield from read_events()
+    if not empty:
+        parser.close()
+        yield from read_events()
+
+
+def _endpoint_field(endpoint, path, elem):
+    if len(path) == 1:
+        endpoint.key = elem.get("PRIMARY_KEY", "")
+    elif len(path) == 2 and path[1] in ENDPOINT_FIELDS:
+        setattr(endpoint, ENDPOINT_FIELDS[path[1]], elem.text or "")
+
+
+def parse_service_groups(chunks):
+    """Yields a ServiceGroup for each SERVICE_GROUP of get_service_group"""
+    group = ServiceGroup()
+    endpoint = ServiceEndpoint("")
+    for path, elem in _records(chunks):
+        if path[0] != "SERVICE_GROUP":
+            continue
+        if len(path) == 1:
+            yield group
+            group = ServiceGroup()
+        elif path == ("SERVICE_GROUP", "NAME"):
+            group.name = elem.text or ""
+        elif path[1] == "SERVICE_ENDPOINT":
+            _endpoint_field(endpoint, path[1:], elem)
+            if len(path) == 2:
+                group.endpoints.append(endpoint)
+                endpoint = ServiceEndpoint("")
+
+
+def parse_services(chunks, links=None):
+    """Yields a ServiceEndpoint for each SERVICE_ENDPOINT of get_service
+
+    If links is given, the href of the links of the result page are added
+    to it with their rel as key.
+    """
+    endpoint = ServiceEndpoint("")
+    for path, elem in _records(chunks):
+        if path[0] == "SERVICE_ENDPOINT":
+            _endpoint_field(endpoint, path, elem)
+            if len(path) == 1:
+                yield endpoint
+                endpoint = ServiceEndpoint("")
+        elif path == ("meta", "link") and links is not None:
+            links[elem.get("rel")] = elem.get("href")
@@ -0,0 +1,120 @@
+"""HTTP client shared by the data sources of the monitors"""
+
+import contextlib
+import importlib.util
+import threading
+import time
+
+import httpx
+
+HTTP_TIMEOUT = 60
+HTTP_RETRIES = 3
+# seconds before the first retry, doubled on every retry
+HTTP_BACKOFF = 0.5
+# concurrent requests to the same host
+HTTP_HOST_CONCURRENCY = 10
+# responses worth retrying
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+# HTTP/2 is only available when the h2 package is installed
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+
+class HttpClient:
+    """Keep-alive client with retries and a concurrency limit per host
+
+    Requests failing with a transport error or a RETRY_STATUS_CODES
+    response are retried with exponential backoff. There is an httpx
+    client per client certificate, shared by all the threads.
+    """
+
+    def __init__(
+        self,
+        timeout=HTTP_TIMEOUT,
+        retries=HTTP_RETRIES,
+        backoff=HTTP_BACKOFF,
+        host_concurrency=HTTP_HOST_CONCURRENCY,
+    ):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.host_concurrency = host_concurrency
+        self._clients = {}
+        self._host_limits = {}
+        self._lock = threading.Lock()
+
+    def _new_client_args(self, cert):
+        return {
+            "cert": cert,
+            "timeout": self.timeout,
+            "http2": HTTP2,
+            "limits": httpx.Limits(max_keepalive_connections=self.host_concurrency),
+        }
+
+    def _client(self, cert):
+        with self._lock:
+            if cert not in self._clients:
+                self._clients[cert] = httpx.Client(**self._new_client_args(cert))
+            return self._clients[cert]
+
+    def _host_limit(self, url):
+        host = httpx.URL(url).host
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(
+                    self.host_concurrency
+                )
+            return self._host_limits[host]
+
+    def _send(self, url, params, cert, stream, follow_redirects):
+        client = self._client(cert)
+        request = client.build_request("GET", url, params=params)
+        for attempt in range(self.retries + 1):
+            try:
+                response = client.send(
+                    request, stream=stream, follow_redirects=follow_redirects
+                )
+            except httpx.TransportError:
+                if attempt == self.retries:
+                    raise
+            else:
+                if (
+                    response.status_code not in RETRY_STATUS_CODES
+                    or attempt == self.retries
+                ):
+                    return response
+                response.close()
+            time.sleep(self.backoff * 2**attempt)
+
+    def get(self, url, params=None, cert=None, follow_redirects=False):
+        """Returns the response of a GET request, with the body read"""
+        with self._host_limit(url):
+            return self._send(url, params, cert, False, follow_redirects)
+
+    @contextlib.contextmanager
+    def stream(self, url, params=None, cert=None, follow_redirects=False):
+        """Context manager of a GET response whose body is read as it comes"""
+        with self._host_limit(url):
+            response = self._send(url, params, cert, True, follow_redirects)
+            try:
+                yield response
+            finally:
+                response.close()
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
+
+
+_shared_client = None
+_shared_lock = threading.Lock()
+
+
+def shared_client():
+    """Returns the HttpClient used by default by all the data sources"""
+    global _shared_client
+    with _shared_lock:
+        if _shared_client is None:
+            _shared_client = HttpClient()
+        return _shared_client
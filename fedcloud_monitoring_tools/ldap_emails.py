@@ -0,0 +1,75 @@
+"""E-mail lookup of VO members in the Check-in LDAP"""
+
+import threading
+import time
+
+import ldap3
+from ldap3.utils.conv import escape_filter_chars
+
+EMAIL_TTL = 3600
+LDAP_BATCH_SIZE = 50
+
+
+class LdapEmails:
+    """Gets the e-mails of the given users only
+
+    Users are searched in batches with a single filter over a connection
+    reused for the whole run. Results (including users not found) are kept
+    for ttl seconds, so an instance can be shared by all the sites checked.
+    LDAP errors are raised as ldap3 LDAPException.
+    """
+
+    def __init__(self, ldap_config, ttl=EMAIL_TTL, batch_size=LDAP_BATCH_SIZE):
+        self.ldap_config = ldap_config
+        self.ttl = ttl
+        self.batch_size = batch_size
+        # user -> (time of the lookup, e-mail or None if not found)
+        self._emails = {}
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None:
+            server = ldap3.Server(self.ldap_config["server"], get_info=ldap3.ALL)
+            self._conn = ldap3.Connection(
+                server,
+                self.ldap_config["username"],
+                password=self.ldap_config["password"],
+                auto_bind=True,
+            )
+        return self._conn
+
+    def _is_cached(self, user, now):
+        return user in self._emails and now - self._emails[user][0] < self.ttl
+
+    def _search(self, users, now):
+        user_filter = "".join(
+            f"(voPersonID={escape_filter_chars(user)})" for user in users
+        )
+        search_filter = f"(&{self.ldap_config['search_filter']}(|{user_filter}))"
+        # users are marked as not found first, so failed searches are not retried
+        for user in users:
+            self._emails[user] = (now, None)
+        conn = self._connection()
+        conn.search(
+            self.ldap_config["base_dn"],
+            search_filter,
+            attributes=["voPersonID", "mail"],
+        )
+        for entry in conn.entries:
+            self._emails[entry["voPersonID"].value] = (now, entry["mail"].value)
+
+    def prefetch(self, users):
+        """Looks up the users that are not cached yet"""
+        with self._lock:
+            now = time.monotonic()
+            missing = sorted(
+                set(user for user in users if user and not self._is_cached(user, now))
+            )
+            for i in range(0, len(missing), self.batch_size):
+                self._search(missing[i : i + self.batch_size], now)
+
+    def get(self, user):
+        """Returns the e-mail of the user or None if not found"""
+        self.prefetch([user])
+        return self._emails.get(user, (None, None))[1]
@@ -0,0 +1,305 @@
+"""Backends for running OpenStack commands of the VM monitor"""
+
+import threading
+
+import openstack
+from fedcloudclient.openstack import (
+    DEFAULT_IDENTITY_PROVIDER,
+    DEFAULT_PROTOCOL,
+    fedcloud_openstack,
+)
+from fedcloudclient.sites import find_endpoint_and_project_id
+from keystoneauth1 import session as ks_session
+from keystoneauth1.exceptions import ClientException
+from keystoneauth1.identity.v3 import OidcAccessToken
+
+# same code used by fedcloudclient when the VO is not supported at the site
+MISSING_VO_ERROR_CODE = 1
+# image attributes of openstacksdk shown by the CLI within the properties
+IMAGE_PROPERTY_ATTRIBUTES = ["os_distro", "os_version"]
+
+
+class SubprocessBackend:
+    """Runs the openstack CLI via fedcloudclient, one process per command"""
+
+    def __init__(self, token):
+        self.token = token
+
+    def site_project(self, site, vo):
+        """Returns the endpoint, project ID and protocol of the VO at the site"""
+        return find_endpoint_and_project_id(site, vo)
+
+    def run(self, site, vo, command, json_output=True):
+        return fedcloud_openstack(
+            self.token, site, vo, command, json_output=json_output
+        )
+
+
+class SessionBackend:
+    """Calls the OpenStack APIs from this process
+
+    Keeps one authenticated keystone session per (site, VO), whose HTTP
+    connections are reused by all the calls (and threads) of that pair.
+    The commands it does not know about, and the unscoped ones, go to
+    the openstack CLI as with SubprocessBackend. Results have the same
+    format as the JSON output of the CLI.
+    """
+
+    # image list includes the properties of the images, unlike the CLI
+    lists_image_properties = True
+
+    def __init__(self, token):
+        self.token = token
+        self.fallback = SubprocessBackend(token)
+        self._connections = {}
+        # one lock per (site, VO), so the lookups of different sites overlap
+        self._connection_locks = {}
+        self._lock = threading.Lock()
+        self.handlers = {
+            ("server", "list"): self.server_list,
+            ("server", "show"): self.server_show,
+            ("server", "delete"): self.server_delete,
+            ("flavor", "list"): self.flavor_list,
+            ("image", "show"): self.image_show,
+            ("image", "list"): self.image_list,
+            ("volume", "show"): self.volume_show,
+            ("volume", "list"): self.volume_list,
+            ("floating", "ip"): self.floating_ip_list,
+            ("security", "group"): self.security_group_list,
+            ("port", "list"): self.port_list,
+            ("quota", "show"): self.quota_show,
+        }
+
+    def get_connection(self, site, vo):
+        with self._lock:
+            lock = self._connection_locks.setdefault((site, vo), threading.Lock())
+        with lock:
+            if (site, vo) not in self._connections:
+                endpoint, project_id, protocol = self.site_project(site, vo)
+                if endpoint is None:
+                    conn = None
+                else:
+                    auth = OidcAccessToken(
+                        auth_url=endpoint,
+                        identity_provider=DEFAULT_IDENTITY_PROVIDER,
+                        protocol=protocol or DEFAULT_PROTOCOL,
+                        access_token=self.token,
+                        project_id=project_id,
+                    )
+                    sess = ks_session.Session(auth=auth)
+                    conn = openstack.connection.Connection(session=sess)
+                self._connections[(site, vo)] = conn
+            return self._connections[(site, vo)]
+
+    def site_project(self, site, vo):
+        return self.fallback.site_project(site, vo)
+
+    def run(self, site, vo, command, json_output=True):
+        handler = self.handlers.get(tuple(command[:2]))
+        if vo is None or handler is None:
+            return self.fallback.run(site, vo, command, json_output=json_output)
+        conn = self.get_connection(site, vo)
+        if conn is None:
+            return MISSING_VO_ERROR_CODE, f"VO {vo} not found on site {site}\n"
+        try:
+            return 0, handler(conn, command)
+        except (openstack.exceptions.SDKException, ClientException) as e:
+            return 1, str(e)
+
+    def _option(self, command, option):
+        if option in command:
+            return command[command.index(option) + 1]
+        return None
+
+    def _image_properties(self, image):
+        properties = dict(image.properties or {})
+        for attr in IMAGE_PROPERTY_ATTRIBUTES:
+            value = getattr(image, attr, None)
+            if value is not None:
+                properties[attr] = value
+        return properties
+
+    def server_list(self, conn, command):
+        images = {image.id: image.name for image in conn.image.images()}
+        flavors = {}
+        result = []
+        for server in conn.compute.servers(details=True):
+            image_id = (server.image or {}).get("id", "")
+            if image_id:
+                image_name = images.get(image_id, "")
+            else:
+                image_name = "N/A (booted from volume)"
+            flavor_name = server.flavor.get("original_name") or server.flavor.get(
+                "name"
+            )
+            if not flavor_name:
+                if not flavors:
+                    flavors = {f.id: f.name for f in conn.compute.flavors()}
+                flavor_name = flavors.get(server.flavor.get("id"), "")
+            result.append(
+                {
+                    "ID": server.id,
+                    "Name": server.name,
+                    "Status": server.status,
+                    "Networks": {
+                        net: [addr["addr"] for addr in addrs]
+                        for net, addrs in (server.addresses or {}).items()
+                    },
+                    "Image Name": image_name,
+                    "Image ID": image_id,
+                    "Flavor": flavor_name,
+                    "Created At": server.created_at,
+                    "Security Groups": [
+                        secgroup["name"] for secgroup in server.security_groups or []
+                    ],
+                    "User ID": server.user_id,
+                    "Properties": server.metadata or {},
+                }
+            )
+        return result
+
+    def server_show(self, conn, command):
+        server = conn.compute.get_server(command[2])
+        return {
+            "id": server.id,
+            "name": server.name,
+            "status": server.status,
+            "created_at": server.created_at,
+            "security_groups": server.security_groups or [],
+            "attached_volumes": [
+                {"id": volume["id"]} for volume in server.attached_volumes or []
+            ],
+            "user_id": server.user_id,
+            "properties": server.metadata or {},
+        }
+
+    def server_delete(self, conn, command):
+        conn.compute.delete_server(command[2])
+        return ""
+
+    def flavor_list(self, conn, command):
+        return [
+            {
+                "ID": flavor.id,
+                "Name": flavor.name,
+                "RAM": flavor.ram,
+                "Disk": flavor.disk,
+                "VCPUs": flavor.vcpus,
+            }
+            for flavor in conn.compute.flavors()
+        ]
+
+    def image_show(self, conn, command):
+        image = conn.image.get_image(command[2])
+        return {
+            "id": image.id,
+            "name": image.name,
+            "properties": self._image_properties(image),
+        }
+
+    def image_list(self, conn, command):
+        return [
+            {
+                "ID": image.id,
+                "Name": image.name,
+                "Status": image.status,
+                "properties": self._image_properties(image),
+            }
+            for image in conn.image.images()
+        ]
+
+    def volume_show(self, conn, command):
+        volume = conn.block_storage.get_volume(command[2])
+        result = {"id": volume.id, "name": volume.name}
+        if volume.volume_image_metadata:
+            result["volume_image_metadata"] = volume.volume_image_metadata
+        return result
+
+    def volume_list(self, conn, command):
+        query = {}
+        status = self._option(command, "--status")
+        if status:
+            query["status"] = status
+        return [
+            {
+                "ID": volume.id,
+                "Name": volume.name or "",
+                "Status": volume.status,
+                "Size": volume.size,
+                "Attached to": volume.attachments or [],
+            }
+            for volume in conn.block_storage.volumes(details=True, **query)
+        ]
+
+    def floating_ip_list(self, conn, command):
+        query = {}
+        status = self._option(command, "--status")
+        if status:
+            query["status"] = status
+        return [
+            {
+                "ID": fip.id,
+                "Floating IP Address": fip.floating_ip_address,
+                "Fixed IP Address": fip.fixed_ip_address,
+                "Port": fip.port_id,
+            }
+            for fip in conn.network.ips(**query)
+        ]
+
+    def security_group_list(self, conn, command):
+        query = {}
+        project_id = self._option(command, "--project")
+        if project_id:
+            query["project_id"] = project_id
+        return [
+            {"ID": secgroup.id, "Name": secgroup.name}
+            for secgroup in conn.network.security_groups(**query)
+        ]
+
+    def port_list(self, conn, command):
+        query = {}
+        project_id = self._option(command, "--project")
+        if project_id:
+            query["project_id"] = project_id
+        return [
+            {
+                "ID": port.id,
+                "Device Owner": port.device_owner,
+                "Security Groups": port.security_group_ids or [],
+            }
+            for port in conn.network.ports(**query)
+        ]
+
+    def quota_show(self, conn, command):
+        project_id = conn.current_project_id
+        result = []
+        compute = conn.compute.get_quota_set(project_id, usage=True)
+        for resource in ["cores", "instances", "ram"]:
+            result.append(
+                {
+                    "Resource": resource,
+                    "In Use": compute.usage.get(resource, 0),
+                    "Limit": getattr(compute, resource),
+                }
+            )
+        network = conn.network.get_quota(project_id, details=True)
+        for resource, attr in [
+            ("floating-ips", "floating_ips"),
+            ("secgroup-rules", "security_group_rules"),
+            ("secgroups", "security_groups"),
+        ]:
+            value = getattr(network, attr) or {}
+            result.append(
+                {
+                    "Resource": resource,
+                    "In Use": value.get("used", 0),
+                    "Limit": value.get("limit", 0),
+                }
+            )
+        return result
+
+
+BACKENDS = {
+    "cli": SubprocessBackend,
+    "session": SessionBackend,
+}
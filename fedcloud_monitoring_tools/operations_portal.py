@@ -1,15 +1,16 @@
 """Operations Portal queries"""
 
-import requests
+from fedcloud_monitoring_tools.http_client import shared_client
 
 
 class OpsPortal:
-    def __init__(self):
+    def __init__(self, http=None):
         self.vo_list = []
+        self.http = http or shared_client()
 
     def get_vo_list(self):
         if len(self.vo_list) == 0:
-            r = requests.get(
+            r = self.http.get(
                 "http://cclavoisier01.in2p3.fr:8080/lavoisier/VoList?accept=json"
             )
             r.raise_for_status()
@@ -0,0 +1,144 @@
+"""Network probes on the public IPs of the VMs"""
+
+import asyncio
+
+SSH_PORT = 22
+CUPS_PORT = 631
+PROBE_TIMEOUT = 5
+PROBE_CONCURRENCY = 50
+# lines a SSH server may send before its version (RFC 4253, section 4.2)
+MAX_SSH_PRE_BANNER_LINES = 10
+
+SSH_ERROR = "SSHException: could not retrieve SSH version"
+CUPS_OPEN = "WARNING: CUPS port is open"
+CUPS_CLOSED = "CUPS port is closed"
+
+
+class _UDPProbe(asyncio.DatagramProtocol):
+    def __init__(self, result):
+        self.result = result
+
+    def datagram_received(self, data, addr):
+        if not self.result.done():
+            self.result.set_result(True)
+
+    def error_received(self, exc):
+        # ICMP port unreachable is reported as ConnectionRefusedError
+        if not self.result.done():
+            if isinstance(exc, ConnectionRefusedError):
+                self.result.set_result(False)
+            else:
+                self.result.set_exception(exc)
+
+
+class PortProber:
+    """Probes SSH banners and CUPS ports of many IPs concurrently
+
+    Each probe is limited by timeout seconds and at most concurrency
+    probes are in flight at any time.
+    """
+
+    def __init__(self, timeout=PROBE_TIMEOUT, concurrency=PROBE_CONCURRENCY):
+        self.timeout = timeout
+        self.concurrency = concurrency
+
+    async def get_ssh_version(self, ip):
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(ip, SSH_PORT), self.timeout
+            )
+        except (OSError, asyncio.TimeoutError):
+            return SSH_ERROR
+        try:
+            for _ in range(MAX_SSH_PRE_BANNER_LINES):
+                line = await asyncio.wait_for(reader.readline(), self.timeout)
+                if not line:
+                    break
+                banner = line.decode("utf-8", errors="replace").rstrip("\r\n")
+                if banner.startswith("SSH-"):
+                    return banner
+            return SSH_ERROR
+        except (OSError, asyncio.TimeoutError):
+            return SSH_ERROR
+        finally:
+            writer.close()
+
+    async def check_tcp_port(self, ip, port):
+        """Returns True if open, False if closed and an error message otherwise"""
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(ip, port), self.timeout
+            )
+        except (ConnectionRefusedError, asyncio.TimeoutError):
+            return False
+        except OSError as e:
+            return str(e)
+        writer.close()
+        return True
+
+    async def check_udp_port(self, ip, port):
+        """Returns True if open, False if closed and an error message otherwise
+
+        The port is only considered open if something answers, as done by
+        ncat --udp with an idle timeout.
+        """
+        loop = asyncio.get_running_loop()
+        result = loop.create_future()
+        try:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: _UDPProbe(result), remote_addr=(ip, port)
+            )
+        except OSError as e:
+            return str(e)
+        try:
+            transport.sendto(b"")
+            return await asyncio.wait_for(result, self.timeout)
+        except asyncio.TimeoutError:
+            return False
+        except OSError as e:
+            return str(e)
+        finally:
+            transport.close()
+
+    async def check_cups(self, ip):
+        tcp, udp = await asyncio.gather(
+            self.check_tcp_port(ip, CUPS_PORT), self.check_udp_port(ip, CUPS_PORT)
+        )
+        if tcp is True or udp is True:
+            return CUPS_OPEN
+        elif tcp is False and udp is False:
+            return CUPS_CLOSED
+        return f"Error checking CUPS port. TCP: {tcp}. UDP: {udp}."
+
+    async def _probe(self, semaphore, ip, probe):
+        async with semaphore:
+            return await probe(ip)
+
+    async def _probe_all(self, ips, ssh, cups):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        probes = []
+        if ssh:
+            probes.append(("ssh", self.get_ssh_version))
+        if cups:
+            probes.append(("cups", self.check_cups))
+        tasks = {
+            (ip, name): asyncio.ensure_future(self._probe(semaphore, ip, probe))
+            for ip in ips
+            for name, probe in probes
+        }
+        await asyncio.gather(*tasks.values())
+        results = {ip: {} for ip in ips}
+        for (ip, name), task in tasks.items():
+            results[ip][name] = task.result()
+        return results
+
+    def probe(self, ips, ssh=False, cups=False):
+        """Runs the selected probes on all the ips
+
+        Returns a dict with ip as key and a dict with the "ssh" and/or
+        "cups" results as value.
+        """
+        ips = set(ips)
+        if not ips or not (ssh or cups):
+            return {ip: {} for ip in ips}
+        return asyncio.run(self._probe_all(ips, ssh, cups))
@@ -0,0 +1,296 @@
+"""Output formats of the VM monitor"""
+
+import abc
+import csv
+import io
+import json
+import threading
+from collections import defaultdict
+from datetime import timedelta
+
+import click
+
+# lines of the text output of a VM: (label, key in the VM record)
+VM_TEXT_FIELDS = [
+    ("instance name", "name"),
+    ("instance id", "id"),
+    ("status", "status"),
+    ("ip address", "ip_addresses"),
+    ("sec. groups", "security_groups"),
+    ("SSH version", "ssh_version"),
+    ("CUPS", "cups"),
+    ("flavor", "flavor"),
+    ("VM image", "image"),
+    ("created at", "created_at"),
+    ("elapsed time", "elapsed"),
+    ("user", "user"),
+    ("egi user", "egi_user"),
+    ("email", "email"),
+    ("IM id", "im_id"),
+]
+CSV_FIELDS = [
+    "type",
+    "site",
+    "vo",
+    "id",
+    "name",
+    "status",
+    "ip_addresses",
+    "security_groups",
+    "ssh_version",
+    "cups",
+    "flavor",
+    "image",
+    "created_at",
+    "elapsed",
+    "user",
+    "egi_user",
+    "email",
+    "im_id",
+    "expired",
+    "resource",
+    "in_use",
+    "limit",
+    "items",
+    "capacity",
+    "change",
+    "message",
+]
+
+# records of concurrent sites are written as whole lines
+_write_lock = threading.Lock()
+
+
+class TextReporter:
+    """Human readable output
+
+    When out is given, output goes there (keeping the styles) instead of
+    stdout, so it can be flushed later as a single block.
+    """
+
+    # VMs are shown once all of them are processed, with a progress bar
+    streaming = False
+    color_maps = defaultdict(lambda: "red", ACTIVE="green", BUILD="yellow")
+
+    def __init__(self, site, vo, out=None):
+        self.site = site
+        self.vo = vo
+        self.out = out
+
+    def echo(self, message=""):
+        # styles are kept in the buffer, they are handled when it's flushed
+        color = True if self.out is not None else None
+        click.echo(message, file=self.out, color=color)
+
+    def warning(self, message):
+        self.echo(click.style(f"[-] WARNING: {message}", fg="yellow"))
+
+    def error(self, message):
+        click.echo(" ".join([click.style("ERROR:", fg="red"), message]), err=True)
+
+    def vm(self, index, record):
+        self.echo(f"[+] VM #{index:<2} {'-'*50}")
+        for label, key in VM_TEXT_FIELDS:
+            if key not in record:
+                continue
+            value = record[key]
+            if key == "status":
+                value = click.style(value, fg=self.color_maps[value])
+            elif key == "ip_addresses":
+                value = " ".join(value)
+            elif key == "security_groups":
+                value = set(value)
+            self.echo(f"    {label:<14} = {value}")
+        if record["expired"]:
+            self.echo(
+                click.style(
+                    "[-] WARNING The VM instance elapsed time exceed the max offset!",
+                    fg="yellow",
+                )
+            )
+
+    def quota(self, quota_info):
+        self.echo("[+] Quota information:")
+        for k, v in quota_info.items():
+            if v["Limit"] == 0:
+                percent = 0
+            else:
+                percent = round(v["In Use"] / v["Limit"] * 100)
+            self.echo(
+                "    {:<14} = Limit: {:>3}, Used: {:>3} ({}%)".format(
+                    k, v["Limit"], v["In Use"], percent
+                )
+            )
+
+    def unused_floating_ips(self, floating_ips):
+        if len(floating_ips) > 0:
+            self.warning(f"List of unused floating IPs: {floating_ips}")
+
+    def unused_volumes(self, volumes, capacity):
+        if capacity > 0:
+            self.warning(f"List of unused volumes: {volumes}")
+            self.warning(
+                f"{capacity} GB could be claimed back deleting unused volumes."
+            )
+
+    def unused_security_groups(self, secgroups):
+        """secgroups is a dict with the ID as key and the name as value"""
+        if len(secgroups) > 0:
+            secgroups = ", ".join(
+                f"{name} ({secgroup_id})" for secgroup_id, name in secgroups.items()
+            )
+            self.warning(f"List of unused security groups: {secgroups}")
+
+    def changes(self, last_scan, created, deleted, expired):
+        self.echo(
+            f"[+] Changes since the last run ({last_scan:%Y-%m-%d %H:%M} UTC): "
+            f"{len(created)} created, {len(deleted)} deleted, "
+            f"{len(expired)} newly over the max offset"
+        )
+        for label, records in [
+            ("created", created),
+            ("deleted", deleted),
+            ("expired", expired),
+        ]:
+            for record in records:
+                self.echo(f"    {label:<14} = {record['id']} ({record['name']})")
+
+    def deletion_plan(self, vms):
+        self.echo(
+            click.style(
+                f"[-] {len(vms)} VM instance(s) exceed the max offset and will be deleted:",
+                fg="yellow",
+            )
+        )
+        for vm in vms:
+            self.echo(f"    {vm['ID']} ({vm['Name']})")
+
+    def deletion_report(self, vms, errors):
+        failed = [vm_id for vm_id, error in errors.items() if error is not None]
+        self.echo(
+            f"[+] Deletion report: {len(errors) - len(failed)} deleted, "
+            f"{len(failed)} failed"
+        )
+        for vm_id in failed:
+            self.echo(f"    {click.style(vm_id, fg='red')} = {errors[vm_id]}")
+
+
+class RecordReporter(TextReporter, abc.ABC):
+    """Base of the machine readable outputs, one record per line
+
+    Records are written as soon as they are reported, informative messages
+    go to stderr.
+    """
+
+    streaming = True
+
+    def echo(self, message=""):
+        click.echo(message, err=True)
+
+    def record(self, record_type, **fields):
+        record = {"type": record_type, "site": self.site, "vo": self.vo}
+        record.update(fields)
+        line = self.format(record)
+        with _write_lock:
+            click.echo(line, file=self.out)
+
+    @abc.abstractmethod
+    def format(self, record):
+        """Returns the line of the record"""
+
+    def warning(self, message):
+        self.record("warning", message=message)
+
+    def error(self, message):
+        self.record("error", message=message)
+
+    def vm(self, index, record):
+        self.record("vm", **record)
+
+    def quota(self, quota_info):
+        for resource, value in quota_info.items():
+            self.record(
+                "quota", resource=resource, in_use=value["In Use"], limit=value["Limit"]
+            )
+
+    def unused_floating_ips(self, floating_ips):
+        self.record("unused_floating_ips", items=list(floating_ips))
+
+    def unused_volumes(self, volumes, capacity):
+        self.record("unused_volumes", items=list(volumes), capacity=capacity)
+
+    def unused_security_groups(self, secgroups):
+        self.record("unused_security_groups", items=sorted(secgroups))
+
+    def changes(self, last_scan, created, deleted, expired):
+        for change, records in [
+            ("created", created),
+            ("deleted", deleted),
+            ("expired", expired),
+        ]:
+            for record in records:
+                self.record(
+                    "change",
+                    id=record["id"],
+                    name=record["name"],
+                    change=change,
+                    message=f"since {last_scan.isoformat()}",
+                )
+
+    def deletion_report(self, vms, errors):
+        for vm in vms:
+            if vm["ID"] in errors:
+                self.record(
+                    "deletion",
+                    id=vm["ID"],
+                    name=vm["Name"],
+                    status="FAILED" if errors[vm["ID"]] else "DELETED",
+                    message=errors[vm["ID"]] or "",
+                )
+
+
+def _json_default(value):
+    if isinstance(value, timedelta):
+        return int(value.total_seconds())
+    if isinstance(value, set):
+        return sorted(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class JsonlReporter(RecordReporter):
+    """One JSON object per line, elapsed time is given in seconds"""
+
+    def format(self, record):
+        return json.dumps(record, default=_json_default)
+
+
+class CsvReporter(RecordReporter):
+    """CSV rows with the CSV_FIELDS columns, lists are space separated"""
+
+    @classmethod
+    def header(cls):
+        return cls._row(CSV_FIELDS)
+
+    @staticmethod
+    def _row(values):
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="").writerow(values)
+        return buffer.getvalue()
+
+    def format(self, record):
+        values = []
+        for field in CSV_FIELDS:
+            value = record.get(field, "")
+            if isinstance(value, (list, set)):
+                value = " ".join(str(v) for v in value)
+            elif isinstance(value, timedelta):
+                value = int(value.total_seconds())
+            values.append(value)
+        return self._row(values)
+
+
+REPORTERS = {
+    "text": TextReporter,
+    "jsonl": JsonlReporter,
+    "csv": CsvReporter,
+}
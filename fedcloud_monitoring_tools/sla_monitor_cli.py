@@ -1,70 +1,145 @@
 """Monitor Accounting status"""
 
-import importlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
 import click
-import yaml
 from fedcloud_monitoring_tools.accounting import Accounting
+from fedcloud_monitoring_tools.accounting_matrix import AccountingMatrix
+from fedcloud_monitoring_tools.accounting_store import AccountingStore
+from fedcloud_monitoring_tools.cache import CACHE_DIR, PersistentCache
 from fedcloud_monitoring_tools.fedcloud_is import FedCloudIS
 from fedcloud_monitoring_tools.goc import GOCDB
+from fedcloud_monitoring_tools.http_client import shared_client
 from fedcloud_monitoring_tools.operations_portal import OpsPortal
+from fedcloud_monitoring_tools.snapshot import (
+    SnapshotHttpClient,
+    open_snapshot,
+    snapshot_call,
+)
+from fedcloud_monitoring_tools.vo_map import VoMap
 from fedcloudclient.sites import list_sites
 
+# number of VOs with the highest usage shown in the accounting summary
+SUMMARY_TOP_VOS = 10
+# sites checked concurrently, once all the data sources are fetched
+SITE_WORKERS = 10
+
+
+@dataclass
+class SlaCheck:
+    name: str
+    # VOs of the SLA with accounting and configured at the site
+    accounted_vos: set
+    configured_vos: set
+
+
+@dataclass
+class SiteSlaResult:
+    site: str
+    # None if the site is not in any SLA
+    slas: list[SlaCheck] | None
+    # VOs with accounting or configured at the site without a SLA
+    non_sla_vos: set
+    non_sla_fcis_vos: set
+    ops_accounted: bool
+    ops_configured: bool
+    # VOs with accounting in the previous months but not in the last one
+    stopped_vos: set = field(default_factory=set)
+
 
 def check_site_slas(site, acct, fcis, goc, gocdb_sites):
+    """Returns the SiteSlaResult of the site, without showing anything"""
     sla_vos = set()
     fcis_vos = set(fcis.get_vos_for_site(site))
+    acct_vos = acct.site_vos(site)
+    slas = None
+    if site in gocdb_sites:
+        slas = []
+        for sla_name, sla in gocdb_sites[site].items():
+            sla_vos = sla_vos.union(sla["vos"])
+            slas.append(
+                SlaCheck(
+                    sla_name,
+                    sla["vos"].intersection(acct_vos),
+                    sla["vos"].intersection(fcis_vos),
+                )
+            )
+    # Now check which VOs are being reported without a SLA
+    if not sla_vos:
+        sla_vos = goc.sla_vos
+    return SiteSlaResult(
+        site,
+        slas,
+        non_sla_vos=acct_vos - sla_vos.union(set(["ops"])),
+        non_sla_fcis_vos=fcis_vos - sla_vos.union(set(["ops"])),
+        ops_accounted="ops" in acct_vos,
+        ops_configured="ops" in fcis_vos,
+        stopped_vos=acct.stopped_vos(site),
+    )
+
+
+def show_site_slas(result):
+    site = result.site
     click.secho(f"[-] Checking site {site}", fg="blue", bold=True)
-    if site not in gocdb_sites:
+    if result.slas is None:
         click.echo(f"[I] {site} is not present in any SLA")
     else:
-        for sla_name, sla in gocdb_sites[site].items():
-            click.echo(f"Information for SLA {sla_name}")
-            sla_vos = sla_vos.union(sla["vos"])
-            accounted_vos = sla["vos"].intersection(acct.site_vos(site))
-            if accounted_vos:
+        for sla in result.slas:
+            click.echo(f"Information for SLA {sla.name}")
+            if sla.accounted_vos:
                 click.echo(
-                    f"[OK] {site} has accounting info for SLA {sla_name} ({accounted_vos})"
+                    f"[OK] {site} has accounting info for SLA {sla.name} "
+                    f"({sla.accounted_vos})"
                 )
             else:
-                click.echo(f"[ERR] {site} has no accounting info for SLA {sla_name}")
-            info_vos = sla["vos"].intersection(fcis_vos)
-            if info_vos:
-                click.echo(f"[OK] {site} has configured {info_vos} for SLA {sla_name}")
+                click.echo(f"[ERR] {site} has no accounting info for SLA {sla.name}")
+            if sla.configured_vos:
+                click.echo(
+                    f"[OK] {site} has configured {sla.configured_vos} for SLA {sla.name}"
+                )
             else:
-                click.echo(f"[ERR] {site} has no configured VO for SLA {sla_name}")
+                click.echo(f"[ERR] {site} has no configured VO for SLA {sla.name}")
             click.echo()
     click.secho(f"[-] Checking aditional VOs at {site}", fg="yellow", bold=True)
-    # Now check which VOs are being reported without a SLA
-    if not sla_vos:
-        sla_vos = goc.sla_vos
-    non_sla_vos = acct.site_vos(site) - sla_vos.union(set(["ops"]))
-    if non_sla_vos:
+    if result.non_sla_vos:
         click.echo(
-            f"[W] {site} has accounting for VOs {non_sla_vos} but not covered by SLA"
+            f"[W] {site} has accounting for VOs {result.non_sla_vos} "
+            "but not covered by SLA"
         )
-    if "ops" not in acct.site_vos(site):
+    if not result.ops_accounted:
         click.echo(f"[W] {site} has no accounting for ops")
-    non_sla_fcis_vos = fcis_vos - sla_vos.union(set(["ops"]))
-    if non_sla_vos:
+    if result.stopped_vos:
         click.echo(
-            f"[W] {site} has VOs {non_sla_fcis_vos} configured but not covered by SLA"
+            f"[W] {site} has no accounting for VOs {result.stopped_vos} last month"
         )
-    if "ops" not in fcis_vos:
+    if result.non_sla_fcis_vos:
+        click.echo(
+            f"[W] {site} has VOs {result.non_sla_fcis_vos} configured "
+            "but not covered by SLA"
+        )
+    if not result.ops_configured:
         click.echo(f"[W] {site} has no configuration for ops")
     click.echo()
 
 
-def vo_in_map(vo, vo_map):
-    flat_list = []
-    for i in vo_map.values():
-        if i is not None:
-            flat_list += i
-    return vo in flat_list
+def check_sites_slas(sites, acct, fcis, goc, gocdb_sites):
+    """Checks the sites concurrently and shows the results in the same order"""
+    with ThreadPoolExecutor(max_workers=SITE_WORKERS) as executor:
+        results = list(
+            executor.map(
+                lambda site: check_site_slas(site, acct, fcis, goc, gocdb_sites),
+                sites,
+            )
+        )
+    for result in results:
+        show_site_slas(result)
 
 
-def check_vo_sla(acct, fcis, goc, ops_portal, user_cert, vo_map, vo):
-    if not vo_in_map(vo, vo_map):
+def check_vo_sla(
+    acct, fcis, ops_portal_vos, gocdb_vos, sites_fedcloudclient, vo_map, vo
+):
+    if vo not in vo_map:
         click.secho(
             "[ERR] VO {} not found in the map file provided".format(vo),
             fg="red",
@@ -79,20 +154,18 @@ def check_vo_sla(acct, fcis, goc, ops_portal, user_cert, vo_map, vo):
             bold=True,
         )
         return
-    all_vos_ops_portal = ops_portal.get_vo_list()
-    if vo not in all_vos_ops_portal:
+    if vo not in ops_portal_vos:
         click.secho(
             "[ERR] VO {} not found in Operations Portal".format(vo), fg="red", bold=True
         )
         return
-    all_vos_gocdb = goc.get_sites_vo(user_cert, vo_map)
-    if vo not in all_vos_gocdb:
+    if vo not in gocdb_vos:
         click.secho("[ERR] VO {} not found in GOCDB".format(vo), fg="red", bold=True)
         return
-    sites_gocdb = sorted(all_vos_gocdb[vo])
+    sites_gocdb = sorted(gocdb_vos[vo])
     sites_acct = sorted([provider for provider in all_vos_acct[vo]])
     sites_fcis = sorted(fcis.get_sites_for_vo(vo))
-    sites_fedcloudclient = sorted(list_sites(vo))
+    sites_fedcloudclient = sorted(sites_fedcloudclient)
     if sites_gocdb == sites_fcis == sites_acct == sites_fedcloudclient:
         click.secho(
             "[OK] VO {}. The sites supporting the VO are: {}".format(vo, sites_gocdb),
@@ -125,9 +198,75 @@ def check_vo_sla(acct, fcis, goc, ops_portal, user_cert, vo_map, vo):
     click.echo()
 
 
+def get_fedcloudclient_sites(vos, snapshot=None):
+    """Returns a dict with the sites of each VO in the fedcloudclient configuration"""
+    return {
+        vo: snapshot_call(
+            snapshot, "fedcloudclient", ["list_sites", vo], lambda: list_sites(vo)
+        )
+        for vo in vos
+    }
+
+
+def check_vos_slas(
+    vos, acct, fcis, goc, ops_portal, user_cert, vo_map, fedcloudclient_sites
+):
+    """Checks the VOs against the data of all the sources, fetched only once"""
+    ops_portal_vos = set(ops_portal.get_vo_list())
+    gocdb_vos = goc.get_sites_vo(user_cert, vo_map)
+    for vo in vos:
+        check_vo_sla(
+            acct,
+            fcis,
+            ops_portal_vos,
+            gocdb_vos,
+            fedcloudclient_sites[vo],
+            vo_map,
+            vo,
+        )
+
+
+def show_accounting_summary(acct, gocdb_sites, top=SUMMARY_TOP_VOS):
+    try:
+        matrix = AccountingMatrix.from_accounting(acct)
+    except ImportError as e:
+        click.secho(f"[ERR] Cannot show the accounting summary: {e}", fg="red")
+        return
+    click.secho(
+        f"[-] Accounting summary of the last {acct.days} days", fg="blue", bold=True
+    )
+    totals = matrix.vo_totals()
+    shares = matrix.vo_shares()
+    for vo in sorted(totals, key=totals.get, reverse=True)[:top]:
+        click.echo(f"VO: {vo}, CPUh: {totals[vo]:.0f} ({shares[vo]:.1f}%)")
+    # sites of each SLA, and the VOs of the SLA
+    slas = {}
+    for site, site_slas in gocdb_sites.items():
+        for sla_name, sla in site_slas.items():
+            slas.setdefault(sla_name, (sla["vos"], set()))[1].add(site)
+    for sla_name, (vos, sites) in sorted(slas.items()):
+        idle_sites = matrix.zero_usage_sites(vos, sites)
+        if vos and idle_sites:
+            click.echo(
+                f"[W] SLA {sla_name} has no accounting for {vos} at {idle_sites}"
+            )
+    click.echo()
+
+
 @click.command()
 @click.option("--site", help="Site to check")
-@click.option("--vo", help="Monitor SLAs per VO")
+@click.option(
+    "--vo",
+    "vos",
+    multiple=True,
+    help="Monitor SLAs per VO (can be given several times)",
+)
+@click.option(
+    "--all-vos",
+    default=False,
+    is_flag=True,
+    help="Monitor SLAs per VO for all the VOs in the SLA-VO mapping",
+)
 @click.option("--user-cert", required=True, help="User certificate (for GOCDB queries)")
 @click.option("--vo-map-file", help="SLA-VO mapping file")
 @click.option(
@@ -136,32 +275,108 @@ def check_vo_sla(acct, fcis, goc, ops_portal, user_cert, vo_map, vo):
     show_default=True,
     help="Number of days to consider accounting information",
 )
+@click.option(
+    "--summary",
+    default=False,
+    is_flag=True,
+    help="Show a summary of the accounting of the federation (needs numpy)",
+)
+@click.option(
+    "--cache-dir",
+    default=CACHE_DIR,
+    show_default=True,
+    type=click.Path(file_okay=False),
+    help="Directory for caching the GOCDB SLA groups and the accounting data",
+)
+@click.option(
+    "--no-cache",
+    default=False,
+    is_flag=True,
+    help="Do not use the cache directory",
+)
+@click.option(
+    "--record",
+    type=click.Path(dir_okay=False),
+    help="Save the responses of all the data sources to a snapshot file",
+)
+@click.option(
+    "--replay",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Use the responses of a snapshot file instead of the data sources",
+)
 def main(
     site,
-    vo,
+    vos,
+    all_vos,
     user_cert,
     vo_map_file,
     days,
+    summary,
+    cache_dir,
+    no_cache,
+    record,
+    replay,
 ):
-    if vo_map_file:
-        with open(vo_map_file) as f:
-            vo_map_src = f.read()
-    else:
-        vo_map_src = importlib.resources.read_text(
-            "fedcloud_monitoring_tools.data", "vos.yaml"
+    if record and replay:
+        raise click.UsageError("--record and --replay cannot be used together")
+    snapshot = open_snapshot(record, replay)
+    http = None
+    today = None
+    if snapshot:
+        # every response must be in the snapshot, do not get any from the cache
+        no_cache = True
+        http = SnapshotHttpClient(snapshot, None if replay else shared_client())
+        today = snapshot.now().date()
+    cache = None if no_cache else PersistentCache(cache_dir)
+    vo_map = VoMap.load(vo_map_file, cache)
+    if all_vos:
+        vos = sorted(vo_map.vos)
+    store = None if no_cache else AccountingStore(cache_dir)
+    acct = Accounting(days, store=store, http=http, today=today)
+    goc = GOCDB(cache=cache, http=http)
+    fcis = FedCloudIS(http=http)
+    ops_portal = OpsPortal(http=http)
+    # the data sources are independent, query them at the same time
+    with ThreadPoolExecutor() as executor:
+        prefetches = [
+            executor.submit(acct.all_sites),
+            executor.submit(goc.get_slas, user_cert),
+        ]
+        if vos:
+            prefetches.append(executor.submit(ops_portal.get_vo_list))
+            fedcloudclient_sites = executor.submit(
+                get_fedcloudclient_sites, vos, snapshot
+            )
+            prefetches.append(fedcloudclient_sites)
+            for vo in vos:
+                prefetches.append(executor.submit(fcis.get_sites_for_vo, vo))
+        elif site:
+            prefetches.append(executor.submit(fcis.get_vos_for_site, site))
+        else:
+            prefetches.append(executor.submit(fcis.prefetch))
+        for prefetch in prefetches:
+            prefetch.result()
+
+    if vos:
+        check_vos_slas(
+            vos,
+            acct,
+            fcis,
+            goc,
+            ops_portal,
+            user_cert,
+            vo_map,
+            fedcloudclient_sites.result(),
         )
-    vo_map = yaml.load(vo_map_src, Loader=yaml.SafeLoader)
-    acct = Accounting(days)
-    goc = GOCDB()
-    fcis = FedCloudIS()
-    ops_portal = OpsPortal()
-
-    if vo:
-        check_vo_sla(acct, fcis, goc, ops_portal, user_cert, vo_map, vo)
     else:
         gocdb_sites = goc.get_sites_slas(user_cert, vo_map)
-        if site:
-            check_site_slas(site, acct, fcis, goc, gocdb_sites)
-        else:
-            for site in acct.all_sites():
-                check_site_slas(site, acct, fcis, goc, gocdb_sites)
+        sites = [site] if site else acct.all_sites()
+        check_sites_slas(sites, acct, fcis, goc, gocdb_sites)
+    if summary:
+        show_accounting_summary(acct, goc.get_sites_slas(user_cert, vo_map))
+    if cache:
+        cache.close()
+    if store:
+        store.close()
+    if snapshot:
+        snapshot.save()
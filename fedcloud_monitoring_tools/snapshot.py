@@ -0,0 +1,218 @@
+"""Recording and replay of the responses of the external data sources
+
+A snapshot is a gzip-compressed JSON file with the responses of a run,
+grouped by source and keyed by the JSON of each request. Runs replaying it
+get the same data without any network access, so they can be repeated
+and timed.
+"""
+
+import contextlib
+import copy
+import gzip
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+import httpx
+
+SNAPSHOT_VERSION = 1
+
+
+class SnapshotMissing(Exception):
+    """A response needed by a replay is not in the snapshot"""
+
+
+class Snapshot:
+    """Responses of the external data sources of a run
+
+    When recording, call gets the response from the source and keeps it
+    until save writes the file. When replaying, call returns the response
+    from the file and nothing is fetched. It can be shared between threads.
+    """
+
+    def __init__(self, path, replay=False):
+        self.path = path
+        self.replay = replay
+        self._responses = {}
+        self._lock = threading.Lock()
+        if replay:
+            with gzip.open(path, "rt") as f:
+                snapshot = json.load(f)
+            if snapshot.get("version") != SNAPSHOT_VERSION:
+                raise ValueError(f"Unsupported snapshot version in {path}")
+            self._responses = snapshot["responses"]
+
+    def _key(self, request):
+        return json.dumps(request, sort_keys=True)
+
+    def lookup(self, source, request):
+        """Returns a copy of the recorded response, for replays"""
+        with self._lock:
+            try:
+                response = self._responses[source][self._key(request)]
+            except KeyError:
+                raise SnapshotMissing(
+                    f"No {source} response to {self._key(request)} in {self.path}"
+                )
+            return copy.deepcopy(response)
+
+    def store(self, source, request, response):
+        """Keeps the response, as it will be replayed, and returns it"""
+        response = json.loads(json.dumps(response))
+        with self._lock:
+            self._responses.setdefault(source, {})[self._key(request)] = response
+        return copy.deepcopy(response)
+
+    def call(self, source, request, fetch):
+        """Returns the response to the request, fetched only when recording"""
+        if self.replay:
+            return self.lookup(source, request)
+        return self.store(source, request, fetch())
+
+    def now(self):
+        """Returns the time of the recording, so replays get the same dates"""
+        now = self.call("clock", "now", lambda: datetime.now(timezone.utc).isoformat())
+        return datetime.fromisoformat(now)
+
+    def save(self):
+        """Writes the recorded responses to the file"""
+        if self.replay:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with self._lock, gzip.open(tmp_path, "wt") as f:
+            json.dump({"version": SNAPSHOT_VERSION, "responses": self._responses}, f)
+        os.replace(tmp_path, self.path)
+
+
+def open_snapshot(record=None, replay=None):
+    """Returns the Snapshot for the --record or --replay file, if any"""
+    if replay:
+        return Snapshot(replay, replay=True)
+    if record:
+        return Snapshot(record)
+    return None
+
+
+def snapshot_call(snapshot, source, request, fetch):
+    """Calls fetch through the snapshot, or directly if there is none"""
+    if snapshot is None:
+        return fetch()
+    return snapshot.call(source, request, fetch)
+
+
+class SnapshotHttpClient:
+    """HttpClient recording or replaying the responses of a Snapshot
+
+    Only the status, the content type and the body of the responses are
+    kept. Streamed responses are read completely before being recorded.
+    """
+
+    def __init__(self, snapshot, http=None):
+        self.snapshot = snapshot
+        # HttpClient for recording, not used when replaying
+        self.http = http
+
+    def _request(self, url, params):
+        return {"url": str(url), "params": params}
+
+    def _record(self, response):
+        return {
+            "status": response.status_code,
+            "content_type": response.headers.get("content-type"),
+            "content": response.content.decode("utf-8", "surrogateescape"),
+        }
+
+    def _response(self, url, params, recorded):
+        headers = {}
+        if recorded["content_type"]:
+            headers["content-type"] = recorded["content_type"]
+        return httpx.Response(
+            recorded["status"],
+            headers=headers,
+            content=recorded["content"].encode("utf-8", "surrogateescape"),
+            request=httpx.Request("GET", url, params=params),
+        )
+
+    def get(self, url, params=None, cert=None, follow_redirects=False):
+        recorded = self.snapshot.call(
+            "http",
+            self._request(url, params),
+            lambda: self._record(
+                self.http.get(url, params, cert, follow_redirects=follow_redirects)
+            ),
+        )
+        return self._response(url, params, recorded)
+
+    @contextlib.contextmanager
+    def stream(self, url, params=None, cert=None, follow_redirects=False):
+        yield self.get(url, params, cert, follow_redirects)
+
+    def close(self):
+        if self.http:
+            self.http.close()
+
+
+class SnapshotBackend:
+    """OpenStack backend recording or replaying the results of a Snapshot"""
+
+    def __init__(self, snapshot, backend=None):
+        self.snapshot = snapshot
+        # backend for recording, not used when replaying
+        self.backend = backend
+        self.lists_image_properties = snapshot.call(
+            "openstack",
+            "lists_image_properties",
+            lambda: getattr(backend, "lists_image_properties", False),
+        )
+
+    def site_project(self, site, vo):
+        return tuple(
+            self.snapshot.call(
+                "fedcloudclient",
+                ["find_endpoint_and_project_id", site, vo],
+                lambda: self.backend.site_project(site, vo),
+            )
+        )
+
+    def run(self, site, vo, command, json_output=True):
+        return tuple(
+            self.snapshot.call(
+                "openstack",
+                [site, vo, list(command), json_output],
+                lambda: self.backend.run(site, vo, command, json_output=json_output),
+            )
+        )
+
+
+class SnapshotProber:
+    """PortProber recording or replaying the results of a Snapshot"""
+
+    def __init__(self, snapshot, prober=None):
+        self.snapshot = snapshot
+        # PortProber for recording, not used when replaying
+        self.prober = prober
+
+    def probe(self, ips, ssh=False, cups=False):
+        ips = sorted(set(ips))
+        return self.snapshot.call(
+            "probes",
+            [ips, ssh, cups],
+            lambda: self.prober.probe(ips, ssh=ssh, cups=cups),
+        )
+
+
+class SnapshotEmails:
+    """LdapEmails recording or replaying the e-mails of a Snapshot"""
+
+    def __init__(self, snapshot, emails=None):
+        self.snapshot = snapshot
+        # LdapEmails for recording, not used when replaying
+        self.emails = emails
+
+    def prefetch(self, users):
+        if not self.snapshot.replay:
+            self.emails.prefetch(users)
+
+    def get(self, user):
+        return self.snapshot.call("ldap", user, lambda: self.emails.get(user))
@@ -0,0 +1,77 @@
+"""State of the VMs seen by the previous run of the VM monitor"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+STATE_FILE = "state.sqlite"
+
+
+class VmStateStore:
+    """SQLite store of the last scan of each site and VO
+
+    For every VM it keeps the fingerprint of its server listing entry and
+    the record reported for it, so unchanged VMs do not need to be
+    processed again. A scan replaces all the VMs of its site and VO.
+    It can be shared between threads.
+    """
+
+    def __init__(self, state_dir):
+        os.makedirs(state_dir, exist_ok=True)
+        self.path = os.path.join(state_dir, STATE_FILE)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS scans ("
+                "site TEXT, vo TEXT, scanned REAL, PRIMARY KEY (site, vo))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS vms ("
+                "site TEXT, vo TEXT, id TEXT, fingerprint TEXT, record TEXT, "
+                "PRIMARY KEY (site, vo, id))"
+            )
+
+    def load(self, site, vo):
+        """Returns the time of the last scan and its VMs
+
+        VMs are given as a dict with the VM ID as key and a tuple of
+        (fingerprint, record) as value. The time is None if the site and
+        VO were never scanned.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT scanned FROM scans WHERE site = ? AND vo = ?", (site, vo)
+            ).fetchone()
+            if row is None:
+                return None, {}
+            rows = self._db.execute(
+                "SELECT id, fingerprint, record FROM vms WHERE site = ? AND vo = ?",
+                (site, vo),
+            ).fetchall()
+        return row[0], {
+            vm_id: (fingerprint, json.loads(record))
+            for vm_id, fingerprint, record in rows
+        }
+
+    def save(self, site, vo, vms):
+        """Replaces the VMs of the site and VO, given as returned by load"""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM vms WHERE site = ? AND vo = ?", (site, vo))
+            self._db.executemany(
+                "INSERT INTO vms VALUES (?, ?, ?, ?, ?)",
+                [
+                    (site, vo, vm_id, fingerprint, json.dumps(record))
+                    for vm_id, (fingerprint, record) in vms.items()
+                ],
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO scans VALUES (?, ?, ?)",
+                (site, vo, time.time()),
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -1,18 +1,46 @@
 """Monitor VM instances running in the provider"""
 
+import contextlib
+import hashlib
 import ipaddress
-import subprocess
+import json
+import threading
+import time
 from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 
 import click
-import ldap3
-import paramiko
 from dateutil.parser import parse
-from fedcloudclient.openstack import fedcloud_openstack
-from fedcloudclient.sites import find_endpoint_and_project_id
+from fedcloud_monitoring_tools.ldap_emails import LdapEmails
+from fedcloud_monitoring_tools.openstack_backend import SubprocessBackend
+from fedcloud_monitoring_tools.probes import PortProber
+from fedcloud_monitoring_tools.reporters import VM_TEXT_FIELDS, TextReporter
 from ldap3.core.exceptions import LDAPException
-from paramiko import SSHException
+
+# columns of "server list --long" with the details of "server show" used in process_vm
+SERVER_LIST_DETAIL_COLUMNS = [
+    "Created At",
+    "Security Groups",
+    "User ID",
+    "Properties",
+]
+SERVER_LIST_COLUMNS = [
+    "ID",
+    "Name",
+    "Status",
+    "Networks",
+    "Image Name",
+    "Image ID",
+    "Flavor",
+    "Flavor Name",
+    # not available in every openstack client, used for detecting changes
+    "Updated",
+] + SERVER_LIST_DETAIL_COLUMNS
+
+DELETE_WORKERS = 5
+# deletions per second
+DELETE_RATE = 2
 
 
 class VmMonitorException(Exception):
@@ -22,14 +50,32 @@ class VmMonitorException(Exception):
 class VmMonitor:
     """Helper class to call fedcloudclient easily"""
 
-    color_maps = defaultdict(lambda: "red", ACTIVE="green", BUILD="yellow")
     # at least 1GB per core
     min_ram_cpu_ratio = 1
     min_secgroup_instance_ratio = 3
     min_ip_instance_ratio = 1
 
     def __init__(
-        self, site, vo, token, max_days, check_ssh, check_cups, ldap_config={}
+        self,
+        site,
+        vo,
+        token,
+        max_days,
+        check_ssh,
+        check_cups,
+        ldap_config={},
+        workers=1,
+        out=None,
+        request_limit=None,
+        backend=None,
+        prober=None,
+        cache=None,
+        emails=None,
+        reporter=None,
+        delete_workers=DELETE_WORKERS,
+        delete_rate=DELETE_RATE,
+        state=None,
+        now=None,
     ):
         self.site = site
         self.vo = vo
@@ -38,62 +84,197 @@ class VmMonitor:
         self.check_ssh = check_ssh
         self.check_cups = check_cups
         self.ldap_config = ldap_config
+        # LdapEmails, may be shared between monitors
+        if emails is None and ldap_config:
+            emails = LdapEmails(ldap_config)
+        self.emails = emails
+        self.prober = prober or PortProber()
+        # PersistentCache shared between runs, None to disable it
+        self.cache = cache
+        self.probe_results = {}
+        self.workers = max(1, workers)
+        # when out is given, output goes there (keeping the styles) instead of stdout
+        self.out = out
+        self.reporter = reporter or TextReporter(site, vo, out)
+        # semaphore shared between monitors to limit concurrent OpenStack requests
+        self.request_limit = request_limit
+        # backend running the OpenStack commands, may be shared between monitors
+        self.backend = backend or SubprocessBackend(token)
+        # number of OpenStack requests done by this monitor
+        self.requests = 0
+        self._requests_lock = threading.Lock()
         self.flavors = {}
         self.users = defaultdict(lambda: {})
-        self.user_emails = {}
-        self.now = datetime.now(timezone.utc)
-        self.used_security_groups = set()
+        # Futures of the image and volume show results, see _memoize
+        self.images = {}
+        self.volumes = {}
+        # caches are shared by the worker threads of vm_monitor
+        self._flavors_lock = threading.Lock()
+        self._users_lock = threading.Lock()
+        self._memo_lock = threading.Lock()
+        self._volumes_lock = threading.Lock()
+        self.volume_attachments = None
+        self.delete_workers = delete_workers
+        self.delete_rate = delete_rate
+        self._delete_lock = threading.Lock()
+        self._next_delete = 0
+        # VmStateStore with the VMs of the previous run, None to process all VMs
+        self.state = state
+        self.previous_vms = {}
+        # (endpoint, project ID) of the VO at the site, see get_site_project
+        self.site_project = None
+        self._project_lock = threading.Lock()
+        # time the age of the VMs is computed from
+        self.now = now or datetime.now(timezone.utc)
+
+    def echo(self, message=""):
+        self.reporter.echo(message)
+
+    def secho(self, message="", **styles):
+        self.echo(click.style(message, **styles))
 
     def _run_command(self, command, do_raise=True, json_output=True, scoped=True):
         vo = self.vo if scoped else None
-        error_code, result = fedcloud_openstack(
-            self.token, self.site, vo, command, json_output=json_output
-        )
+        with self._requests_lock:
+            self.requests += 1
+        with self.request_limit or contextlib.nullcontext():
+            error_code, result = self.backend.run(
+                self.site, vo, command, json_output=json_output
+            )
         if error_code != 0:
             if do_raise:
                 raise VmMonitorException(result)
             else:
-                click.echo(" ".join([click.style("WARNING:", fg="yellow"), result]))
+                self.echo(" ".join([click.style("WARNING:", fg="yellow"), result]))
                 return {}
         return result
 
+    def _cache_get(self, kind, key):
+        if self.cache is None:
+            return None
+        return self.cache.get(self.site, self.vo, kind, key)
+
+    def _cache_set(self, kind, key, value):
+        if self.cache is not None and value:
+            self.cache.set(self.site, self.vo, kind, key, value)
+
     def get_user(self, user_id):
-        if not self.users:
-            all_users = []
+        with self._users_lock:
+            if not self.users:
+                all_users = self._cache_get("users", "all")
+                # new users may be missing from the cached list
+                if not all_users or user_id not in [u["ID"] for u in all_users]:
+                    all_users = self._get_all_users()
+                    self._cache_set("users", "all", all_users)
+                for user in all_users:
+                    self.users[user["ID"]] = user
+            return self.users[user_id]
+
+    def _get_all_users(self):
+        all_users = []
+        try:
+            command = ("user", "list")
+            all_users = self._run_command(command)
+        except VmMonitorException:
             try:
-                command = ("user", "list")
-                all_users = self._run_command(command)
-            except VmMonitorException:
-                try:
-                    # trick fedcloudclient to give us what we need
-                    command = ("token", "issue")
-                    token = self._run_command(command, scoped=False)
-                    command = ("user", "show", token["user_id"])
-                    my_user = self._run_command(command, scoped=True)
-                    # now we have the domain, can get all users
-                    command = ("user", "list", "--os-domain-id", my_user["domain_id"])
-                    all_users = self._run_command(command, scoped=False)
-                except VmMonitorException as e:
-                    click.secho(f"WARNING: Unable to get user list: {e}", fg="yellow")
-            for user in all_users:
-                self.users[user["ID"]] = user
-        return self.users[user_id]
+                # trick fedcloudclient to give us what we need
+                command = ("token", "issue")
+                token = self._run_command(command, scoped=False)
+                command = ("user", "show", token["user_id"])
+                my_user = self._run_command(command, scoped=True)
+                # now we have the domain, can get all users
+                command = ("user", "list", "--os-domain-id", my_user["domain_id"])
+                all_users = self._run_command(command, scoped=False)
+            except VmMonitorException as e:
+                self.secho(f"WARNING: Unable to get user list: {e}", fg="yellow")
+        return all_users
 
     def get_flavor(self, flavor_name):
-        if flavor_name in self.flavors:
-            return self.flavors[flavor_name]
-        command = ("flavor", "list", "--long")
-        result = self._run_command(command)
-        for flv in result:
-            self.flavors[flv["Name"]] = flv
-        if flavor_name not in self.flavors:
-            return {}
-        return self.flavors[flavor_name]
+        with self._flavors_lock:
+            if not self.flavors:
+                for flv in self._cache_get("flavors", "all") or []:
+                    self.flavors[flv["Name"]] = flv
+            if flavor_name in self.flavors:
+                return self.flavors[flavor_name]
+            command = ("flavor", "list", "--long")
+            result = self._run_command(command)
+            self._cache_set("flavors", "all", result)
+            for flv in result:
+                self.flavors[flv["Name"]] = flv
+            return self.flavors.get(flavor_name, {})
+
+    def _memoize(self, memo, key, fetch):
+        """Returns fetch() once per key and run, also when called concurrently
+
+        memo keeps a Future per key so threads asking for a key that is
+        being fetched wait for it. Errors are memoized as well.
+        """
+        with self._memo_lock:
+            future = memo.get(key)
+            owner = future is None
+            if owner:
+                future = memo[key] = Future()
+        if owner:
+            try:
+                future.set_result(fetch())
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def get_image(self, image_id):
+        def fetch():
+            result = self._cache_get("image", image_id)
+            if result is None:
+                cmd = ("image", "show", image_id)
+                result = self._run_command(cmd)
+                self._cache_set("image", image_id, result)
+            return result
+
+        return self._memoize(self.images, image_id, fetch)
+
+    def get_volume(self, volume_id):
+        def fetch():
+            result = self._cache_get("volume", volume_id)
+            if result is None:
+                cmd = ("volume", "show", volume_id)
+                result = self._run_command(cmd)
+                self._cache_set("volume", volume_id, result)
+            return result
+
+        return self._memoize(self.volumes, volume_id, fetch)
+
+    def needs_image_lookup(self, image_name):
+        return (len(image_name) == 0) or ("booted from volume" in image_name)
+
+    def prefetch_images(self, all_vms):
+        """Gets once the details of every image used by the VMs
+
+        Backends that list the image properties fill the index with a single
+        image listing, otherwise each distinct image is fetched with the
+        worker pool.
+        """
+        image_ids = set(
+            vm["Image ID"]
+            for vm in all_vms
+            if vm["Image ID"] and self.needs_image_lookup(vm["Image Name"])
+        )
+        if not image_ids:
+            return
+        if getattr(self.backend, "lists_image_properties", False):
+            command = ("image", "list", "--long")
+            for image in self._run_command(command, do_raise=False):
+                if image["ID"] in image_ids and "properties" in image:
+                    with self._memo_lock:
+                        future = self.images.setdefault(image["ID"], Future())
+                    if not future.done():
+                        future.set_result({"properties": image["properties"]})
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for image_id in image_ids:
+                executor.submit(self.get_image, image_id)
 
     def get_vm_image_volume_show(self, volume_id):
         try:
-            cmd = ("volume", "show", volume_id)
-            result = self._run_command(cmd)
+            result = self.get_volume(volume_id)
             if ("volume_image_metadata" in result) and (
                 "sl:osname" and "sl:osversion" in result["volume_image_metadata"]
             ):
@@ -127,7 +308,8 @@ class VmMonitor:
         2. openstack image show <image-id>
 
         If not, get details from attached volumes:
-        3a. openstack server show <vm-id>
+        3a. openstack volume list --long (once for all the VMs), unless
+            attached volumes come from openstack server show <vm-id>
         3b. openstack volume show <volume-id>
 
         Parameters
@@ -138,19 +320,20 @@ class VmMonitor:
             The name of the VM image
         image_id: str
             The ID of the VM image
+        attached_volumes: list or None
+            The volumes attached to the VM, None to look them up
 
         Returns
         -------
         str
             a string with the name of the image
         """
-        if (len(image_name) > 0) and ("booted from volume" not in image_name):
+        if not self.needs_image_lookup(image_name):
             return image_name
         else:
             # check image properties with "openstack image show"
             try:
-                cmd = ("image", "show", image_id)
-                result = self._run_command(cmd)
+                result = self.get_image(image_id)
                 if "sl:osname" and "sl:osversion" in result["properties"]:
                     return (
                         result["properties"]["sl:osname"]
@@ -165,58 +348,132 @@ class VmMonitor:
                     )
                 else:
                     # check volumes attached
-                    if len(attached_volumes) > 0:
-                        return self.get_vm_image_volume_show(attached_volumes[0]["id"])
-                    else:
-                        return "image name not found"
+                    return self.get_vm_image_from_volumes(
+                        vm_id, attached_volumes, "image name not found"
+                    )
             except VmMonitorException:
-                if len(attached_volumes) > 0:
-                    return self.get_vm_image_volume_show(attached_volumes[0]["id"])
-                else:
-                    return "image not found"
+                return self.get_vm_image_from_volumes(
+                    vm_id, attached_volumes, "image not found"
+                )
+
+    def get_vm_image_from_volumes(self, vm_id, attached_volumes, not_found):
+        if attached_volumes is None:
+            attached_volumes = self.get_volume_attachments(vm_id)
+        if len(attached_volumes) > 0:
+            return self.get_vm_image_volume_show(attached_volumes[0]["id"])
+        return not_found
 
     def get_vms(self):
+        """List all VMs with the details needed by process_vm
+
+        The extra columns avoid a "server show" per VM, they are silently
+        dropped by older openstack clients and get_vm_info falls back to
+        "server show" then.
+        """
         command = ("server", "list", "--long")
+        for column in SERVER_LIST_COLUMNS:
+            command += ("-c", column)
         return self._run_command(command)
 
     def get_vm(self, vm):
         command = ("server", "show", vm["ID"])
         return self._run_command(command)
 
+    def get_volume_attachments(self, vm_id):
+        with self._volumes_lock:
+            if self.volume_attachments is None:
+                self.volume_attachments = defaultdict(list)
+                command = ("volume", "list", "--long")
+                for volume in self._run_command(command, do_raise=False):
+                    for attachment in volume.get("Attached to", []):
+                        self.volume_attachments[attachment["server_id"]].append(
+                            {"id": volume["ID"]}
+                        )
+            return self.volume_attachments.get(vm_id, [])
+
+    def get_vm_info(self, vm):
+        """Returns the details of the VM as given by "server show"
+
+        Takes them from the server listing when available.
+        """
+        if not all(column in vm for column in SERVER_LIST_DETAIL_COLUMNS):
+            return self.get_vm(vm)
+        return {
+            "created_at": vm["Created At"],
+            "security_groups": [
+                {"name": secgroup} for secgroup in vm["Security Groups"] or []
+            ],
+            "user_id": vm["User ID"],
+            "properties": vm["Properties"] or {},
+            # only needed for getting the image, so get it lazily
+            "attached_volumes": None,
+        }
+
     def delete_vm(self, vm):
-        click.echo(
+        """Deletes the VM, returns None if successful or the error otherwise"""
+        self.echo(
             f"[-] Deleting of the instance [{click.style(vm['ID'], fg='red')}] in progress..."
         )
         command = ("server", "delete", vm["ID"])
-        # this won't work as it does not accept a --json option :(
-        self._run_command(command, do_raise=False, json_output=False)
+        try:
+            # server delete does not accept a --json option
+            self._run_command(command, json_output=False)
+        except VmMonitorException as e:
+            return str(e).strip()
+        return None
+
+    def _wait_delete_slot(self):
+        """Waits so there are no more than delete_rate deletions per second"""
+        with self._delete_lock:
+            now = time.monotonic()
+            slot = max(now, self._next_delete)
+            self._next_delete = slot + 1 / self.delete_rate
+        time.sleep(slot - now)
+
+    def delete_vms(self, vms, assume_yes=False):
+        """Shows the VMs to delete, asks once for confirmation and deletes them
+
+        Deletions run concurrently with delete_workers threads, at most
+        delete_rate per second. Returns a dict with the ID of each VM as key
+        and None or the error as value.
+        """
+        self.reporter.deletion_plan(vms)
+        if not assume_yes and not click.confirm(
+            f"Do you want to delete these {len(vms)} instance(s)?", err=True
+        ):
+            return {}
+
+        def delete(vm):
+            self._wait_delete_slot()
+            return self.delete_vm(vm)
+
+        with ThreadPoolExecutor(max_workers=self.delete_workers) as executor:
+            errors = dict(zip([vm["ID"] for vm in vms], executor.map(delete, vms)))
+        self.reporter.deletion_report(vms, errors)
+        return errors
 
     def get_user_email(self, egi_user):
-        if not self.ldap_config:
+        if not self.emails:
             return ""
-        # TODO: this is untested code
-        if not self.user_emails:
-            try:
-                # get the emails
-                server = ldap3.Server(self.ldap_config["server"], get_info=ldap3.ALL)
-                conn = ldap3.Connection(
-                    server,
-                    self.ldap_config["username"],
-                    password=self.ldap_config["password"],
-                    auto_bind=True,
-                )
-                conn.search(
-                    self.ldap_config["base_dn"],
-                    self.ldap_config["search_filter"],
-                    attributes=["*"],
-                )
-                for entry in conn.entries:
-                    self.user_emails[entry["voPersonID"].value] = entry["mail"].value
-            except LDAPException as e:
-                click.secho(f"WARNING: LDAP error: {e}", fg="yellow")
-        if egi_user not in self.user_emails:
+        try:
+            email = self.emails.get(egi_user)
+        except LDAPException as e:
+            self.secho(f"WARNING: LDAP error: {e}", fg="yellow")
+            email = None
+        if email is None:
             return f"{egi_user} not found in LDAP, has VO membership expired?"
-        return self.user_emails[egi_user]
+        return email
+
+    def prefetch_user_emails(self, all_vms):
+        """Looks up in LDAP the e-mails of all the VM owners at once"""
+        if not self.emails:
+            return
+        user_ids = set(vm["User ID"] for vm in all_vms if vm.get("User ID"))
+        users = [self.get_user(user_id).get("Name") for user_id in user_ids]
+        try:
+            self.emails.prefetch(users)
+        except LDAPException as e:
+            self.secho(f"WARNING: LDAP error: {e}", fg="yellow")
 
     def get_public_ip(self, ip_addresses):
         result = ""
@@ -225,189 +482,300 @@ class VmMonitor:
                 result = ip
         return result
 
+    def get_vm_ips(self, vm):
+        vm_ips = []
+        for net, addrs in vm["Networks"].items():
+            vm_ips.extend(addrs)
+        return vm_ips
+
+    def run_probes(self, all_vms):
+        """Probes concurrently the public IPs of all the VMs"""
+        public_ips = [self.get_public_ip(self.get_vm_ips(vm)) for vm in all_vms]
+        self.probe_results = self.prober.probe(
+            [ip for ip in public_ips if ip], ssh=self.check_ssh, cups=self.check_cups
+        )
+
+    def _get_probe_result(self, public_ip, probe):
+        results = self.probe_results.setdefault(public_ip, {})
+        if probe not in results:
+            results.update(self.prober.probe([public_ip], **{probe: True})[public_ip])
+        return results[probe]
+
     def get_sshd_version(self, ip_addresses):
         public_ip = self.get_public_ip(ip_addresses)
         if len(public_ip) > 0:
-            try:
-                ssh = paramiko.Transport((public_ip, 22))
-                ssh.start_client()
-                result = ssh.remote_version
-                ssh.close()
-                return result
-            except SSHException:
-                return "SSHException: could not retrieve SSH version"
+            return self._get_probe_result(public_ip, "ssh")
         else:
             return "No public IP available to check SSH version."
 
-    def _run_shell_command(self, command):
-        completed = subprocess.run(
-            command,
-            shell=True,
-            capture_output=True,
-            text=True,
-        )
-        return completed.returncode, completed.stdout, completed.stderr
-
-    def check_open_port(self, ip, port, protocol):
-        if protocol == "tcp":
-            command = f"ncat --nodns -z {ip} {port}"
-        elif protocol == "udp":
-            command = f"ncat --udp --nodns --idle-timeout 3s {ip} {port}"
-        else:
-            raise VmMonitorException(f"Protocol {protocol} not supported!")
-        returncode, stdout, stderr = self._run_shell_command(command)
-        return returncode, stdout, stderr
-
     def check_CUPS(self, ip_addresses):
-        returncode_ncat, stdout_ncat, stderr_ncat = self._run_shell_command(
-            "which ncat"
-        )
-        if returncode_ncat != 0:
-            return "ncat ( https://nmap.org/ncat ) is not installed"
         public_ip = self.get_public_ip(ip_addresses)
         if len(public_ip) > 0:
-            returncode_tcp, stdout_tcp, stderr_tcp = self.check_open_port(
-                public_ip, 631, "tcp"
-            )
-            returncode_upd, stdout_upd, stderr_upd = self.check_open_port(
-                public_ip, 631, "udp"
-            )
-            if returncode_tcp == 0 or returncode_upd == 0:
-                return "WARNING: CUPS port is open"
-            elif returncode_tcp == 1 and returncode_upd == 1:
-                return "CUPS port is closed"
-            else:
-                return (
-                    "Error checking CUPS port. "
-                    "TCP return code: {returncode_tcp}, stdout: {stdout_tcp}, stderr: {stderr_tcp}. "
-                    "UDP return code: {returncode_upd}, stdout: {stdout_upd}, stderr: {stderr_upd}."
-                )
+            return self._get_probe_result(public_ip, "cups")
         else:
             return "No public IP available to check CUPs version"
 
+    def vm_fingerprint(self, vm):
+        """Hash of the server listing entry, changes when the VM is modified"""
+        listing = json.dumps(vm, sort_keys=True, default=str)
+        return hashlib.sha256(listing.encode()).hexdigest()
+
+    def is_unchanged(self, vm):
+        previous = self.previous_vms.get(vm["ID"])
+        return previous is not None and previous[0] == self.vm_fingerprint(vm)
+
+    def refresh_vm(self, vm):
+        """Reuses the record of the previous run of an unchanged VM
+
+        Only the probes and the fields depending on the current time are
+        computed again.
+        """
+        record = dict(self.previous_vms[vm["ID"]][1])
+        vm_ips = record["ip_addresses"]
+        record.pop("ssh_version", None)
+        record.pop("cups", None)
+        if self.check_ssh:
+            record["ssh_version"] = self.get_sshd_version(vm_ips)
+        if self.check_cups:
+            record["cups"] = self.check_CUPS(vm_ips)
+        elapsed = self.now - parse(record["created_at"])
+        record["elapsed"] = elapsed
+        record["expired"] = elapsed.days >= self.max_days
+        # same order of fields as process_vm
+        record = {
+            key: record[key]
+            for key in [key for _, key in VM_TEXT_FIELDS] + ["expired"]
+            if key in record
+        }
+        return {
+            "ID": vm["ID"],
+            "record": record,
+            "elapsed": elapsed,
+        }
+
     def process_vm(self, vm):
-        vm_info = self.get_vm(vm)
-        flv = self.get_flavor(vm["Flavor"])
-        vm_ips = []
-        for net, addrs in vm["Networks"].items():
-            vm_ips.extend(addrs)
-        sshd_version = self.get_sshd_version(vm_ips)
+        if self.is_unchanged(vm):
+            return self.refresh_vm(vm)
+        vm_info = self.get_vm_info(vm)
+        flv = self.get_flavor(vm.get("Flavor", vm.get("Flavor Name")))
+        vm_ips = self.get_vm_ips(vm)
         created = parse(vm_info["created_at"])
         elapsed = self.now - created
         secgroups = set([secgroup["name"] for secgroup in vm_info["security_groups"]])
-        output = [
-            ("instance name", vm["Name"]),
-            ("instance id", vm["ID"]),
-            ("status", click.style(vm["Status"], fg=self.color_maps[vm["Status"]])),
-            ("ip address", " ".join(vm_ips)),
-            ("sec. groups", secgroups),
-        ]
+        record = {
+            "name": vm["Name"],
+            "id": vm["ID"],
+            "status": vm["Status"],
+            "ip_addresses": vm_ips,
+            "security_groups": sorted(secgroups),
+        }
         if self.check_ssh:
-            sshd_version = self.get_sshd_version(vm_ips)
-            output.append(("SSH version", sshd_version))
+            record["ssh_version"] = self.get_sshd_version(vm_ips)
         if self.check_cups:
-            CUPS_check = self.check_CUPS(vm_ips)
-            output.append(("CUPS", CUPS_check))
+            record["cups"] = self.check_CUPS(vm_ips)
         if flv:
-            output.append(
-                (
-                    "flavor",
-                    f"{flv['Name']} with {flv['VCPUs']} vCPU cores, {int(flv['RAM']/1024)} "
-                    f"GB of RAM and {flv['Disk']} GB of local disk",
-                )
-            )
-        output.append(
-            (
-                "VM image",
-                self.get_vm_image(
-                    vm["ID"],
-                    vm["Image Name"],
-                    vm["Image ID"],
-                    vm_info["attached_volumes"],
-                ),
+            record["flavor"] = (
+                f"{flv['Name']} with {flv['VCPUs']} vCPU cores, {int(flv['RAM']/1024)} "
+                f"GB of RAM and {flv['Disk']} GB of local disk"
             )
+        record["image"] = self.get_vm_image(
+            vm["ID"],
+            vm["Image Name"],
+            vm["Image ID"],
+            vm_info["attached_volumes"],
         )
-        output.append(("created at", vm_info["created_at"]))
-        output.append(("elapsed time", elapsed))
+        record["created_at"] = vm_info["created_at"]
+        record["elapsed"] = elapsed
         user_id = vm_info["user_id"]
-        output.append(("user", user_id))
+        record["user"] = user_id
         user = self.get_user(user_id)
         if user:
             if "email" not in user:
-                self.users[user_id]["email"] = self.get_user_email(
-                    user.get("Name", None)
-                )
-            output.append(("egi user", user.get("Name", "")))
-            output.append(("email", user.get("email", "")))
+                email = self.get_user_email(user.get("Name", None))
+                with self._users_lock:
+                    self.users[user_id]["email"] = email
+            record["egi_user"] = user.get("Name", "")
+            record["email"] = user.get("email", "")
         orchestrator = vm_info["properties"].get("eu.egi.cloud.orchestrator", None)
         if orchestrator == "es.upv.grycap.im":
-            output.append(
-                ("IM id", vm_info["properties"].get("eu.egi.cloud.orchestrator.id", ""))
+            record["im_id"] = vm_info["properties"].get(
+                "eu.egi.cloud.orchestrator.id", ""
             )
+        record["expired"] = elapsed.days >= self.max_days
         return {
             "ID": vm["ID"],
-            "output": output,
+            "record": record,
             "elapsed": elapsed,
-            "secgroups": secgroups,
         }
 
-    def vm_monitor(self, delete=False):
+    def process_vms(self, all_vms, on_done=None):
+        """Process all the VMs with a pool of self.workers threads
+
+        Yields the results in the same order as all_vms, each one as soon
+        as it and the ones before are done, regardless of the order in
+        which the workers finish. on_done is called every time a VM is
+        processed.
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {
+                executor.submit(self.process_vm, vm): i for i, vm in enumerate(all_vms)
+            }
+            done = {}
+            next_index = 0
+            try:
+                for future in as_completed(futures):
+                    # results are only kept until they are yielded
+                    done[futures.pop(future)] = future.result()
+                    if on_done:
+                        on_done()
+                    while next_index in done:
+                        yield done.pop(next_index)
+                        next_index += 1
+            except BaseException:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+    def vm_monitor(self, delete=False, assume_yes=False):
         all_vms = self.get_vms()
+        if self.state:
+            last_scan, self.previous_vms = self.state.load(self.site, self.vo)
         if not all_vms:
-            click.secho("- No VM instances found in the resource provider", fg="yellow")
+            self.secho("- No VM instances found in the resource provider", fg="yellow")
+            # the VMs of the last run are all deleted
+            if self.state:
+                self.save_state(all_vms, {}, last_scan)
             return
-        click.echo(
+        self.echo(
             f"[+] Total VM instance(s) running in the resource provider = {len(all_vms)}"
         )
-        vms_info = []
-        with click.progressbar(all_vms, label="Getting VMs information") as vms:
-            for vm in vms:
-                vms_info.append(self.process_vm(vm))
+        if self.check_ssh or self.check_cups:
+            self.run_probes(all_vms)
+        changed_vms = [vm for vm in all_vms if not self.is_unchanged(vm)]
+        if self.state and last_scan:
+            self.echo(
+                f"[+] VM instance(s) changed since the last run = {len(changed_vms)}"
+            )
+        self.prefetch_images(changed_vms)
+        self.prefetch_user_emails(changed_vms)
+        if self.reporter.streaming:
+            vms_info = self.process_vms(all_vms)
+        else:
+            with click.progressbar(
+                length=len(all_vms), label="Getting VMs information", file=self.out
+            ) as bar:
+                vms_info = list(self.process_vms(all_vms, lambda: bar.update(1)))
+        expired_vms = []
+        # records of the VMs, only needed for the incremental state
+        records = {} if self.state else None
         for i, vm in enumerate(vms_info):
-            click.echo(f"[+] VM #{i:<2} {'-'*50}")
-            for line in vm["output"]:
-                click.echo(f"    {line[0]:<14} = {line[1]}")
-            if vm["elapsed"].days >= self.max_days:
-                click.secho(
-                    "[-] WARNING The VM instance elapsed time exceed the max offset!",
-                    fg="yellow",
-                )
-                if delete:
-                    if click.confirm("Do you want to delete the instance?"):
-                        self.delete_vm(vm)
-            # union of sets
-            self.used_security_groups = self.used_security_groups | vm["secgroups"]
+            self.reporter.vm(i, vm["record"])
+            if records is not None:
+                records[vm["ID"]] = vm["record"]
+            if vm["record"]["expired"]:
+                expired_vms.append(all_vms[i])
+        if self.state:
+            self.save_state(all_vms, records, last_scan)
+        if delete and expired_vms:
+            self.delete_vms(expired_vms, assume_yes)
+
+    def save_state(self, all_vms, records, last_scan):
+        """Stores the VMs of this run and reports the changes since last_scan"""
+        if last_scan:
+            previous = self.previous_vms
+            created = [records[vm_id] for vm_id in records if vm_id not in previous]
+            deleted = [
+                record
+                for vm_id, (_, record) in previous.items()
+                if vm_id not in records
+            ]
+            expired = [
+                record
+                for vm_id, record in records.items()
+                if record["expired"]
+                and not (vm_id in previous and previous[vm_id][1]["expired"])
+            ]
+            self.reporter.changes(
+                datetime.fromtimestamp(last_scan, timezone.utc),
+                created,
+                deleted,
+                expired,
+            )
+        vms = {}
+        for vm in all_vms:
+            # elapsed is computed again on every run
+            record = {k: v for k, v in records[vm["ID"]].items() if k != "elapsed"}
+            vms[vm["ID"]] = (self.vm_fingerprint(vm), record)
+        self.state.save(self.site, self.vo, vms)
+
+    def check_site(self, delete=False, assume_yes=False, show_quotas=False):
+        """Runs the VM scan and the checks of the other resources of the site
+
+        The resources are listed concurrently with the VM scan and reported
+        once it is done, in the same order as when run one by one.
+        """
+        checks = [
+            (self.get_unused_floating_ips, self.reporter.unused_floating_ips),
+            (self.get_unused_security_groups, self.reporter.unused_security_groups),
+            (self.get_unused_volumes, self.report_unused_volumes),
+        ]
+        if show_quotas:
+            checks.insert(0, (self.get_quota, self.report_quotas))
+        with ThreadPoolExecutor(max_workers=len(checks)) as executor:
+            futures = [(executor.submit(get), report) for get, report in checks]
+            try:
+                self.vm_monitor(delete, assume_yes)
+                for future, report in futures:
+                    report(future.result())
+            except BaseException:
+                for future, _ in futures:
+                    future.cancel()
+                raise
+
+    def get_site_project(self):
+        """Returns the endpoint and project ID of the VO at the site
+
+        They are discovered once and shared by all the checks.
+        """
+        with self._project_lock:
+            if self.site_project is None:
+                endpoint, project_id, _ = self.backend.site_project(self.site, self.vo)
+                self.site_project = (endpoint, project_id)
+            return self.site_project
+
+    def get_unused_security_groups(self):
+        """Returns a dict with the ID and name of the security groups not in use"""
+        _, project_id = self.get_site_project()
+        command = ("security", "group", "list", "--project", project_id)
+        all_secgroups = {
+            secgroup["ID"]: secgroup["Name"] for secgroup in self._run_command(command)
+        }
+        # security groups are applied to the ports of the VMs
+        command = ("port", "list", "--long", "--project", project_id)
+        for column in ["ID", "Device Owner", "Security Groups"]:
+            command += ("-c", column)
+        used_secgroups = set()
+        for port in self._run_command(command):
+            if (port["Device Owner"] or "").startswith("compute:"):
+                used_secgroups.update(port["Security Groups"] or [])
+        return {
+            secgroup_id: name
+            for secgroup_id, name in all_secgroups.items()
+            if secgroup_id not in used_secgroups
+        }
 
     def check_unused_security_groups(self):
-        _, project_id, _ = find_endpoint_and_project_id(self.site, self.vo)
-        command = ("security", "group", "list", "--project", project_id)
-        result = self._run_command(command)
-        # until we get security group IDs attached to VMs
-        # all_secgroups = set([secgroup["ID"] for secgroup in result])
-        all_secgroups = set([secgroup["Name"] for secgroup in result])
-        unused_secgroups = all_secgroups - self.used_security_groups
-        if len(unused_secgroups) > 0:
-            click.secho(
-                "[-] WARNING: List of unused security groups: {}".format(
-                    unused_secgroups
-                ),
-                fg="yellow",
-            )
+        self.reporter.unused_security_groups(self.get_unused_security_groups())
 
-    def check_unused_floating_ips(self):
+    def get_unused_floating_ips(self):
         # get list of unused floating IPs in <vo, site>
         command = ("floating", "ip", "list", "--status", "DOWN")
         result = self._run_command(command)
-        floating_ips_down = [fip["Floating IP Address"] for fip in result]
-        if len(floating_ips_down) > 0:
-            click.secho(
-                "[-] WARNING: List of unused floating IPs: {}".format(
-                    floating_ips_down
-                ),
-                fg="yellow",
-            )
+        return [fip["Floating IP Address"] for fip in result]
 
-    def check_unused_volumes(self):
+    def check_unused_floating_ips(self):
+        self.reporter.unused_floating_ips(self.get_unused_floating_ips())
+
+    def get_unused_volumes(self):
         # get list of unused volumes in <vo, site>
         command = ("volume", "list", "--status", "available")
         result = self._run_command(command)
@@ -418,28 +786,38 @@ class VmMonitor:
             unused_volumes.append(
                 volume["Name"] if len(volume["Name"]) > 0 else volume["ID"]
             )
-        if unused_capacity > 0:
-            click.secho(
-                "[-] WARNING: List of unused volumes: {}".format(unused_volumes),
-                fg="yellow",
-            )
-            click.secho(
-                "[-] WARNING: {} GB could be claimed back deleting unused volumes.".format(
-                    unused_capacity
-                ),
-                fg="yellow",
-            )
+        return unused_volumes, unused_capacity
+
+    def report_unused_volumes(self, unused):
+        unused_volumes, unused_capacity = unused
+        self.reporter.unused_volumes(unused_volumes, unused_capacity)
+
+    def check_unused_volumes(self):
+        self.report_unused_volumes(self.get_unused_volumes())
 
     def vo_check(self):
-        endpoint, _, _ = find_endpoint_and_project_id(self.site, self.vo)
+        endpoint, _ = self.get_site_project()
         return endpoint is not None
 
     def get_quota(self):
+        """Returns the quota usage and the error message if it failed
+
+        The error is reported by report_quotas, so it is not printed in the
+        middle of the VM scan when the quota is read concurrently.
+        """
         command = ("quota", "show", "--usage")
-        return self._run_command(command, do_raise=False)
+        try:
+            return self._run_command(command), None
+        except VmMonitorException as e:
+            return {}, str(e)
 
     def show_quotas(self):
-        quota = self.get_quota()
+        self.report_quotas(self.get_quota())
+
+    def report_quotas(self, quota):
+        quota, error = quota
+        if error is not None:
+            self.echo(" ".join([click.style("WARNING:", fg="yellow"), error]))
         if not quota:
             return
         resources = [
@@ -463,47 +841,29 @@ class VmMonitor:
                         "In Use": r["In Use"],
                         "Limit": r["Limit"],
                     }
-        for k, v in quota_info.items():
-            if v["Limit"] == 0:
-                click.echo(
-                    "    {:<14} = Limit: {:>3}, Used: {:>3} ({}%)".format(
-                        k, v["Limit"], v["In Use"], 0
-                    )
-                )
-            else:
-                click.echo(
-                    "    {:<14} = Limit: {:>3}, Used: {:>3} ({}%)".format(
-                        k,
-                        v["Limit"],
-                        v["In Use"],
-                        round(v["In Use"] / v["Limit"] * 100),
-                    )
-                )
+        self.reporter.quota(quota_info)
         # checks on quota
         if (
             quota_info.get("ram (GB)").get("Limit", 1)
             / quota_info.get("cores").get("Limit", 1)
             < self.min_ram_cpu_ratio
         ):
-            click.secho(
-                f"[-] WARNING: Less than {self.min_ram_cpu_ratio} GB RAM per available CPU",
-                fg="yellow",
+            self.reporter.warning(
+                f"Less than {self.min_ram_cpu_ratio} GB RAM per available CPU"
             )
         if (
             quota_info.get("secgroups").get("Limit", 1)
             / quota_info.get("instances").get("Limit", 1)
             < self.min_secgroup_instance_ratio
         ):
-            click.secho(
-                f"[-] WARNING: Less than {self.min_secgroup_instance_ratio} security groups per instance",
-                fg="yellow",
+            self.reporter.warning(
+                f"Less than {self.min_secgroup_instance_ratio} security groups per instance"
             )
         if (
             quota_info.get("floating-ips").get("Limit", 1)
             / quota_info.get("instances").get("Limit", 1)
             < self.min_ip_instance_ratio
         ):
-            click.secho(
-                f"[-] WARNING: Less than {self.min_ip_instance_ratio} floating IPs per instance",
-                fg="yellow",
+            self.reporter.warning(
+                f"Less than {self.min_ip_instance_ratio} floating IPs per instance"
             )
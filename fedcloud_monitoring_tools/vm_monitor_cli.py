@@ -1,8 +1,37 @@
 """Monitor VM instances running in the provider"""
 
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import click
+from fedcloud_monitoring_tools.cache import CACHE_DIR, PersistentCache
 from fedcloud_monitoring_tools.fedcloud_is import FedCloudIS
-from fedcloud_monitoring_tools.vm_monitor import VmMonitor, VmMonitorException
+from fedcloud_monitoring_tools.http_client import shared_client
+from fedcloud_monitoring_tools.ldap_emails import LdapEmails
+from fedcloud_monitoring_tools.openstack_backend import BACKENDS
+from fedcloud_monitoring_tools.probes import (
+    PROBE_CONCURRENCY,
+    PROBE_TIMEOUT,
+    PortProber,
+)
+from fedcloud_monitoring_tools.reporters import REPORTERS, CsvReporter
+from fedcloud_monitoring_tools.snapshot import (
+    SnapshotBackend,
+    SnapshotEmails,
+    SnapshotHttpClient,
+    SnapshotProber,
+    open_snapshot,
+    snapshot_call,
+)
+from fedcloud_monitoring_tools.state import VmStateStore
+from fedcloud_monitoring_tools.vm_monitor import (
+    DELETE_RATE,
+    DELETE_WORKERS,
+    VmMonitor,
+    VmMonitorException,
+)
 from fedcloudclient.decorators import oidc_params
 from fedcloudclient.sites import list_sites
 
@@ -26,8 +55,29 @@ from fedcloudclient.sites import list_sites
     "--delete",
     default=False,
     is_flag=True,
-    help="Ask for deletion of VMs",
+    help="Ask for deletion of VMs exceeding --max-days",
+    show_default=True,
+)
+@click.option(
+    "--yes",
+    "assume_yes",
+    default=False,
+    is_flag=True,
+    help="Delete without asking for confirmation",
+)
+@click.option(
+    "--delete-workers",
+    default=DELETE_WORKERS,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of VMs deleted concurrently at each site",
+)
+@click.option(
+    "--delete-rate",
+    default=DELETE_RATE,
     show_default=True,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Maximum number of VM deletions per second at each site",
 )
 @click.option(
     "--show-quotas",
@@ -47,6 +97,85 @@ from fedcloudclient.sites import list_sites
     help="Check whether TCP/UDP port 631 is accessible",
     show_default=True,
 )
+@click.option(
+    "--probe-timeout",
+    default=PROBE_TIMEOUT,
+    show_default=True,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Timeout in seconds for each SSH and CUPS probe",
+)
+@click.option(
+    "--probe-concurrency",
+    default=PROBE_CONCURRENCY,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Maximum number of SSH and CUPS probes running at the same time",
+)
+@click.option(
+    "--workers",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of VMs to process concurrently at each site",
+)
+@click.option(
+    "--site-workers",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of sites to check concurrently",
+)
+@click.option(
+    "--max-requests",
+    default=0,
+    show_default=True,
+    type=click.IntRange(min=0),
+    help="Maximum number of concurrent OpenStack requests across all sites (0 for no limit)",
+)
+@click.option(
+    "--openstack-backend",
+    default="cli",
+    show_default=True,
+    type=click.Choice(list(BACKENDS)),
+    help="Run the openstack CLI for every request or call the APIs from a session per site",
+)
+@click.option(
+    "--format",
+    "output_format",
+    default="text",
+    show_default=True,
+    type=click.Choice(list(REPORTERS)),
+    help="Output format, jsonl and csv give one record per line as soon as available",
+)
+@click.option(
+    "--cache-dir",
+    default=CACHE_DIR,
+    show_default=True,
+    type=click.Path(file_okay=False),
+    help="Directory for the cache and the state of --incremental runs",
+)
+@click.option(
+    "--no-cache",
+    default=False,
+    is_flag=True,
+    help="Do not use the cache directory",
+)
+@click.option(
+    "--incremental",
+    default=False,
+    is_flag=True,
+    help="Only process the VMs changed since the previous run and show the changes",
+)
+@click.option(
+    "--record",
+    type=click.Path(dir_okay=False),
+    help="Save the responses of OpenStack and the other data sources to a snapshot file",
+)
+@click.option(
+    "--replay",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Use the responses of a snapshot file instead of OpenStack and the other data sources",
+)
 @click.option(
     "--ldap-server",
     default="ldaps://ldap.aai.egi.eu:636",
@@ -73,15 +202,36 @@ def main(
     vo,
     max_days,
     delete,
+    assume_yes,
+    delete_workers,
+    delete_rate,
     show_quotas,
     check_ssh,
     check_cups,
+    probe_timeout,
+    probe_concurrency,
+    workers,
+    site_workers,
+    max_requests,
+    openstack_backend,
+    output_format,
+    cache_dir,
+    no_cache,
+    incremental,
+    record,
+    replay,
     ldap_server,
     ldap_base_dn,
     ldap_user,
     ldap_password,
     ldap_search_filter,
 ):
+    if delete and site_workers > 1 and not assume_yes:
+        raise click.UsageError("--delete with --site-workers > 1 requires --yes")
+    if record and replay:
+        raise click.UsageError("--record and --replay cannot be used together")
+    if incremental and (record or replay):
+        raise click.UsageError("--incremental cannot be used with --record or --replay")
     ldap_config = {}
     if ldap_user and ldap_password:
         ldap_config.update(
@@ -93,22 +243,113 @@ def main(
                 "search_filter": ldap_search_filter,
             }
         )
-    fcis = FedCloudIS()
+    snapshot = open_snapshot(record, replay)
+    http = None
+    now = None
+    if snapshot:
+        # every response must be in the snapshot, do not get any from the cache
+        no_cache = True
+        http = SnapshotHttpClient(snapshot, None if replay else shared_client())
+        now = snapshot.now()
+    fcis = FedCloudIS(http=http)
     fcis_sites = fcis.get_sites_for_vo(vo)
-    fedcloudclient_sites = list_sites(vo)
-    sites = [site] if site else set(fcis_sites + fedcloudclient_sites)
-    for s in sites:
-        click.secho(f"[.] Checking VO {vo} at {s}", fg="blue", bold=True)
+    fedcloudclient_sites = snapshot_call(
+        snapshot, "fedcloudclient", ["list_sites", vo], lambda: list_sites(vo)
+    )
+    sites = [site] if site else sorted(set(fcis_sites + fedcloudclient_sites))
+    emails = None
+    if ldap_config and not replay:
+        emails = LdapEmails(ldap_config)
+    cache = None if no_cache else PersistentCache(cache_dir)
+    state = VmStateStore(cache_dir) if incremental else None
+    prober = None
+    backend = None
+    if not replay:
+        prober = PortProber(probe_timeout, probe_concurrency)
+        backend = BACKENDS[openstack_backend](access_token)
+    if snapshot:
+        if ldap_config:
+            emails = SnapshotEmails(snapshot, emails)
+        prober = SnapshotProber(snapshot, prober)
+        backend = SnapshotBackend(snapshot, backend)
+    request_limit = threading.BoundedSemaphore(max_requests) if max_requests else None
+    timings = {}
+    # messages that are not records go to stderr with machine readable formats
+    err = output_format != "text"
+    if output_format == "csv":
+        click.echo(CsvReporter.header())
+
+    def check_site(s, out=None):
+        start = time.monotonic()
         vm_monitor = VmMonitor(
-            s, vo, access_token, max_days, check_ssh, check_cups, ldap_config
+            s,
+            vo,
+            access_token,
+            max_days,
+            check_ssh,
+            check_cups,
+            ldap_config,
+            workers=workers,
+            out=out,
+            request_limit=request_limit,
+            backend=backend,
+            prober=prober,
+            cache=cache,
+            emails=emails,
+            reporter=REPORTERS[output_format](s, vo, out),
+            delete_workers=delete_workers,
+            delete_rate=delete_rate,
+            state=state,
+            now=now,
         )
+        vm_monitor.secho(f"[.] Checking VO {vo} at {s}", fg="blue", bold=True)
+        error = None
         try:
-            vm_monitor.vm_monitor(delete)
-            if show_quotas:
-                click.echo("[+] Quota information:")
-                vm_monitor.show_quotas()
-            vm_monitor.check_unused_floating_ips()
-            vm_monitor.check_unused_security_groups()
-            vm_monitor.check_unused_volumes()
+            vm_monitor.check_site(delete, assume_yes, show_quotas)
         except VmMonitorException as e:
-            click.echo(" ".join([click.style("ERROR:", fg="red"), str(e)]), err=True)
+            error = e
+            vm_monitor.reporter.error(str(e))
+        timings[s] = (time.monotonic() - start, vm_monitor.requests, error)
+
+    if site_workers == 1:
+        for s in sites:
+            check_site(s)
+    elif err:
+        # records are written one line at a time, no need to buffer them
+        with ThreadPoolExecutor(max_workers=site_workers) as executor:
+            futures = [executor.submit(check_site, s) for s in sites]
+            for future in as_completed(futures):
+                future.result()
+    else:
+        # each site writes to its own buffer that is flushed as a single block
+        lock = threading.Lock()
+
+        def check_buffered_site(s):
+            buffer = io.StringIO()
+            check_site(s, out=buffer)
+            with lock:
+                click.echo(buffer.getvalue(), nl=False)
+
+        with ThreadPoolExecutor(max_workers=site_workers) as executor:
+            futures = [executor.submit(check_buffered_site, s) for s in sites]
+            for future in as_completed(futures):
+                future.result()
+
+    if len(sites) > 1:
+        click.secho("[.] Timing summary", fg="blue", bold=True, err=err)
+        for s in sites:
+            elapsed, requests, error = timings[s]
+            status = click.style("ERROR", fg="red") if error else "OK"
+            click.echo(
+                f"    {s:<30} = {elapsed:8.1f}s {requests:>5} requests {status}",
+                err=err,
+            )
+    if cache:
+        click.secho("[.] Cache statistics", fg="blue", bold=True, err=err)
+        for kind, (hits, misses) in cache.stats().items():
+            click.echo(f"    {kind:<14} = {hits} hits, {misses} misses", err=err)
+        cache.close()
+    if state:
+        state.close()
+    if snapshot:
+        snapshot.save()
@@ -0,0 +1,74 @@
+"""Mapping of the SLAs to the VOs they cover"""
+
+import importlib.resources
+import os
+
+import yaml
+
+# package and file name of the default SLA-VO mapping
+VO_MAP_PACKAGE = "fedcloud_monitoring_tools.data"
+VO_MAP_FILE = "vos.yaml"
+
+
+class VoMap:
+    """SLA-VO mapping with lookups in both directions
+
+    slas is a dict with the SLA name as key and the list of its VOs (or
+    None) as value, as in the YAML mapping files.
+    """
+
+    def __init__(self, slas):
+        self.slas = {name: list(vos or []) for name, vos in slas.items()}
+        self._vo_slas = {}
+        for name, vos in self.slas.items():
+            for vo in vos:
+                self._vo_slas.setdefault(vo, []).append(name)
+        self.vos = frozenset(self._vo_slas)
+
+    def __contains__(self, vo):
+        return vo in self._vo_slas
+
+    def vos_of_sla(self, sla):
+        """Returns the VOs of the SLA, empty if it is not in the mapping"""
+        return self.slas.get(sla, [])
+
+    def slas_of_vo(self, vo):
+        """Returns the SLAs covering the VO"""
+        return self._vo_slas.get(vo, [])
+
+    def is_multi_vo(self, sla):
+        """Returns True if the SLA covers several VOs
+
+        Not all the endpoints of these SLA service groups support all their
+        VOs, so the sites of the SLA are not the sites of each VO.
+        """
+        return len(self.vos_of_sla(sla)) > 1
+
+    @classmethod
+    def from_yaml(cls, source):
+        return cls(yaml.load(source, Loader=yaml.SafeLoader) or {})
+
+    @classmethod
+    def load(cls, path=None, cache=None):
+        """Builds the mapping of the YAML file, or of the packaged vos.yaml
+
+        With a PersistentCache the parsed mapping is kept for the
+        following runs, until the file is modified.
+        """
+        if path is None:
+            resource = importlib.resources.files(VO_MAP_PACKAGE) / VO_MAP_FILE
+            with importlib.resources.as_file(resource) as path:
+                return cls.load(path, cache)
+        if cache is None:
+            with open(path) as f:
+                return cls.from_yaml(f)
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        version = f"{stat.st_mtime_ns}:{stat.st_size}"
+        slas = cache.get(path, None, "vo_map", version)
+        if slas is not None:
+            return cls(slas)
+        with open(path) as f:
+            vo_map = cls.from_yaml(f)
+        cache.set(path, None, "vo_map", version, vo_map.slas)
+        return vo_map
@@ -0,0 +1,125 @@
+import pytest
+from fedcloud_monitoring_tools.goc_xml import (
+    ServiceEndpoint,
+    ServiceGroup,
+    parse_service_groups,
+    parse_services,
+)
+
+# the elements nested in the records reuse the tags of the record fields,
+# only the direct children of the records must be taken
+SERVICE_GROUPS = b"""<?xml version="1.0" encoding="UTF-8"?>
+<results>
+  <SERVICE_GROUP PRIMARY_KEY="10G0">
+    <NAME>EGI_Foo_SLA</NAME>
+    <DESCRIPTION>Foo SLA</DESCRIPTION>
+    <SERVICE_ENDPOINT PRIMARY_KEY="100G0">
+      <HOSTNAME>nova.site-a.eu</HOSTNAME>
+      <SERVICE_TYPE>org.openstack.nova</SERVICE_TYPE>
+      <IN_PRODUCTION>Y</IN_PRODUCTION>
+      <ENDPOINTS>
+        <ENDPOINT>
+          <ID>1</ID>
+          <NAME>endpoint name</NAME>
+          <HOSTNAME>nested.site-a.eu</HOSTNAME>
+          <EXTENSIONS>
+            <EXTENSION><KEY>region</KEY><VALUE>RegionOne</VALUE></EXTENSION>
+          </EXTENSIONS>
+        </ENDPOINT>
+      </ENDPOINTS>
+      <EXTENSIONS>
+        <EXTENSION><KEY>vo</KEY><VALUE>vo.foo.eu</VALUE></EXTENSION>
+      </EXTENSIONS>
+    </SERVICE_ENDPOINT>
+    <SERVICE_ENDPOINT PRIMARY_KEY="101G0">
+      <HOSTNAME>nova.site-b.eu</HOSTNAME>
+      <SERVICE_TYPE>org.openstack.nova</SERVICE_TYPE>
+      <ENDPOINTS/>
+      <EXTENSIONS/>
+    </SERVICE_ENDPOINT>
+    <EXTENSIONS>
+      <EXTENSION><NAME>not the group name</NAME><VALUE>x</VALUE></EXTENSION>
+    </EXTENSIONS>
+  </SERVICE_GROUP>
+  <SERVICE_GROUP PRIMARY_KEY="11G0">
+    <NAME>EGI_Bar_SLA</NAME>
+    <EXTENSIONS/>
+  </SERVICE_GROUP>
+</results>
+"""
+
+SERVICES = b"""<?xml version="1.0" encoding="UTF-8"?>
+<results>
+  <meta>
+    <link rel="self" href="https://goc.egi.eu/gocdbpi/public/?method=get_service&amp;page=1"/>
+    <link rel="next" href="https://goc.egi.eu/gocdbpi/public/?method=get_service&amp;page=2"/>
+  </meta>
+  <SERVICE_ENDPOINT PRIMARY_KEY="100G0">
+    <HOSTNAME>nova.site-a.eu</HOSTNAME>
+    <SERVICE_TYPE>org.openstack.nova</SERVICE_TYPE>
+    <SITENAME>SITE-A</SITENAME>
+    <ENDPOINTS>
+      <ENDPOINT><NAME>endpoint name</NAME><URL>https://nova.site-a.eu</URL></ENDPOINT>
+    </ENDPOINTS>
+    <EXTENSIONS>
+      <EXTENSION><SITENAME>not the site</SITENAME></EXTENSION>
+    </EXTENSIONS>
+  </SERVICE_ENDPOINT>
+  <SERVICE_ENDPOINT PRIMARY_KEY="102G0">
+    <HOSTNAME>nova.site-c.eu</HOSTNAME>
+    <SERVICE_TYPE>org.openstack.nova</SERVICE_TYPE>
+    <SITENAME>SITE-C</SITENAME>
+  </SERVICE_ENDPOINT>
+</results>
+"""
+
+
+def chunked(document, size):
+    return [document[i : i + size] for i in range(0, len(document), size)]
+
+
+@pytest.mark.parametrize("size", [1, 7, 64, len(SERVICE_GROUPS)])
+def test_parse_service_groups(size):
+    groups = list(parse_service_groups(chunked(SERVICE_GROUPS, size)))
+    assert groups == [
+        ServiceGroup(
+            "EGI_Foo_SLA",
+            [
+                ServiceEndpoint("100G0", "nova.site-a.eu", "org.openstack.nova"),
+                ServiceEndpoint("101G0", "nova.site-b.eu", "org.openstack.nova"),
+            ],
+        ),
+        ServiceGroup("EGI_Bar_SLA"),
+    ]
+
+
+@pytest.mark.parametrize("size", [1, 7, 64, len(SERVICES)])
+def test_parse_services(size):
+    links = {}
+    services = list(parse_services(chunked(SERVICES, size), links))
+    assert services == [
+        ServiceEndpoint("100G0", "nova.site-a.eu", "org.openstack.nova", "SITE-A"),
+        ServiceEndpoint("102G0", "nova.site-c.eu", "org.openstack.nova", "SITE-C"),
+    ]
+    assert links == {
+        "self": "https://goc.egi.eu/gocdbpi/public/?method=get_service&page=1",
+        "next": "https://goc.egi.eu/gocdbpi/public/?method=get_service&page=2",
+    }
+
+
+def test_parse_services_without_links():
+    services = list(parse_services([SERVICES]))
+    assert [service.key for service in services] == ["100G0", "102G0"]
+
+
+@pytest.mark.parametrize("chunks", [[], [b""], [b"", b""]])
+def test_parse_empty_body(chunks):
+    links = {}
+    assert list(parse_service_groups(chunks)) == []
+    assert list(parse_services(chunks, links)) == []
+    assert links == {}
+
+
+def test_parse_empty_results():
+    assert list(parse_service_groups([b"<results/>"])) == []
+    assert list(parse_services([b"<results>", b"</results>"])) == []